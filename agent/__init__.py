@@ -1 +1,2 @@
-from .orchestrator import *
\ No newline at end of file
+from .orchestrator import *
+from .answer_cache import *
@@ -0,0 +1,189 @@
+from dotenv import load_dotenv
+import os
+import re
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+import numpy as np
+import requests
+from agno.utils.log import log_debug, log_warning
+from tools.retrieval import get_embedding, normalize_text
+from .orchestrator import init_orchestrator
+
+load_dotenv()
+# Empty string disables the cache
+ANSWER_CACHE_PATH = os.getenv("ANSWER_CACHE_PATH", "./data/answer_cache.sqlite")
+# Cosine similarity above which a reworded question reuses an answer, 0 disables the near-duplicate layer
+ANSWER_CACHE_SIMILARITY = float(os.getenv("ANSWER_CACHE_SIMILARITY", 0.97))
+
+_NUMBER = re.compile(r"\d+(?:[.,]\d+)*")
+_NEGATION = re.compile(r"\b(không|chẳng|chưa|sai)\b")
+
+def normalize_question(text: str) -> str:
+    return normalize_text(text).lower()
+
+def choices_key(choices) -> str:
+    """Choices match exactly, in order, since the answer is a position among them."""
+    return hashlib.sha256("\x1f".join(normalize_question(c) for c in choices).encode("utf-8")).hexdigest()
+
+def question_key(question: str, choices) -> str:
+    return hashlib.sha256(f"{normalize_question(question)}\x00{choices_key(choices)}".encode("utf-8")).hexdigest()
+
+def question_guard(question: str) -> str:
+    """Numbers and negations of a question, rewordings that change them are never near-duplicates.
+
+    Embeddings of "x = 3" and "x = 4", or of "đúng" and "không đúng", are almost identical.
+    """
+    text = normalize_question(question)
+    return json.dumps([_NUMBER.findall(text), len(_NEGATION.findall(text))])
+
+def format_question(question: str, choices) -> str:
+    """Question followed by lettered choices, the prompt format the orchestrator expects."""
+    lines = [question]
+    lines.extend(f"{chr(ord('A') + i)}. {choice}" for i, choice in enumerate(choices))
+    return "\n".join(lines)
+
+class AnswerCache:
+    """Persistent answers keyed by normalized question + choices.
+
+    Misses on the exact key fall back to the most similar cached question with the
+    same choices, numbers and negations, if its embedding is close enough.
+    """
+
+    def __init__(self, path: str = ANSWER_CACHE_PATH, similarity: float = ANSWER_CACHE_SIMILARITY):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.similarity = similarity
+        self.hits = 0
+        self.near_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS answers ("
+            "key TEXT PRIMARY KEY, choices_key TEXT, guard TEXT, question TEXT, "
+            "embedding BLOB, answer TEXT, created REAL)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS answers_choices ON answers (choices_key)")
+        self._db.commit()
+
+        # Unit question embeddings grouped by (choices, guard), the only candidates for a near-duplicate
+        self._answers = {}
+        self._groups = {}
+        for key, choices, guard, embedding, answer in self._db.execute(
+            "SELECT key, choices_key, guard, embedding, answer FROM answers"
+        ):
+            self._remember(key, choices, guard, embedding, json.loads(answer))
+
+    def _remember(self, key, choices, guard, embedding, answer):
+        self._answers[key] = answer
+        if embedding is None:
+            return
+        keys, vectors = self._groups.get((choices, guard), ([], np.zeros((0, 0), dtype="float32")))
+        vector = np.frombuffer(embedding, dtype="float32")[None, :]
+        vectors = vector if len(keys) == 0 else np.concatenate([vectors, vector])
+        self._groups[(choices, guard)] = (keys + [key], vectors)
+
+    def _embed(self, question):
+        if self.similarity <= 0:
+            return None
+        try:
+            embedding = np.asarray(get_embedding(normalize_question(question)), dtype="float32")
+        except requests.RequestException as e:
+            log_warning(f"Answer cache could not embed the question: {e}")
+            return None
+        norm = np.linalg.norm(embedding) if len(embedding) else 0.0
+        return embedding / norm if norm > 0 else None
+
+    def get(self, question: str, choices):
+        key = question_key(question, choices)
+        with self._lock:
+            answer = self._answers.get(key)
+            if answer is not None:
+                self.hits += 1
+                return answer
+
+        group = self._groups.get((choices_key(choices), question_guard(question)))
+        embedding = self._embed(question) if group is not None else None
+        with self._lock:
+            if embedding is not None and len(embedding) == group[1].shape[1]:
+                scores = group[1] @ embedding
+                best = int(np.argmax(scores))
+                if scores[best] >= self.similarity:
+                    self.near_hits += 1
+                    log_debug(f"Answer cache near-duplicate hit, similarity {scores[best]:.4f}")
+                    return self._answers[group[0][best]]
+            self.misses += 1
+        return None
+
+    def put(self, question: str, choices, answer: dict):
+        key = question_key(question, choices)
+        choices_hash = choices_key(choices)
+        guard = question_guard(question)
+        embedding = self._embed(question)
+        blob = embedding.astype("float32").tobytes() if embedding is not None else None
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO answers VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, choices_hash, guard, question, blob, json.dumps(answer, ensure_ascii=False), time.time()),
+            )
+            self._db.commit()
+            if key not in self._answers:
+                self._remember(key, choices_hash, guard, blob, answer)
+            self._answers[key] = answer
+
+    def stats(self):
+        total = self.hits + self.near_hits + self.misses
+        return {
+            "hits": self.hits,
+            "near_hits": self.near_hits,
+            "misses": self.misses,
+            "hit_rate": (self.hits + self.near_hits) / total if total else 0.0,
+            "entries": len(self._answers),
+        }
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+class CachedOrchestrator:
+    """Answers multiple-choice questions from the answer cache, running the orchestrator only on a miss.
+
+    The Team is built on the first miss, a fully cached run never constructs it.
+    """
+
+    def __init__(self, cache=None, orchestrator=None):
+        if cache is None and ANSWER_CACHE_PATH:
+            cache = AnswerCache(ANSWER_CACHE_PATH)
+        self.cache = cache
+        self._orchestrator = orchestrator
+
+    @property
+    def orchestrator(self):
+        if self._orchestrator is None:
+            self._orchestrator = init_orchestrator()
+        return self._orchestrator
+
+    def answer(self, question: str, choices) -> dict:
+        """{"key": ..., "reason": ...} for the question."""
+        if self.cache is not None:
+            cached = self.cache.get(question, choices)
+            if cached is not None:
+                return cached
+
+        response = self.orchestrator.run(format_question(question, choices))
+        content = response.content
+        if hasattr(content, "model_dump"):
+            answer = content.model_dump()
+        elif isinstance(content, dict):
+            answer = content
+        else:
+            # Not parsed into the response model, do not cache an answer without a key
+            return {"key": None, "reason": str(content)}
+
+        if self.cache is not None and answer.get("key"):
+            self.cache.put(question, choices, answer)
+        return answer
@@ -0,0 +1,23 @@
+from tools.retrieval import needs_retrain, replace_documents, retrain_indexes
+import os
+import sys
+
+# Same layout as prepare_knowledge.py, new and changed files are re-embedded, the rest is skipped
+BASE_FOLDER = sys.argv[1] if len(sys.argv) > 1 else "./data/preprocessed_txt"
+
+documents = []
+
+for field in os.listdir(BASE_FOLDER):
+    for file in os.listdir(os.path.join(BASE_FOLDER, field)):
+        file_path = os.path.join(BASE_FOLDER, field, file)
+        with open(file_path, 'r', encoding='utf-8') as file:
+            documents.append({
+                "source": file_path,
+                "text": file.read(),
+                "fields": field.split("-"),
+            })
+
+# A serving process reloads the store on its own, see KNOWLEDGE_RELOAD_INTERVAL
+knowledge = replace_documents(documents, metric="cosine", retrain=False)
+if needs_retrain(knowledge, metric="cosine"):
+    retrain_indexes(metric="cosine", background=False)
@@ -1,30 +1,82 @@
-from fastapi import FastAPI, Response
+from fastapi import FastAPI, Header, Request, Response
+import asyncio
+import time
+from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
 import os
+from contextlib import asynccontextmanager
 from dotenv import load_dotenv
-import requests
+import httpx
 import uvicorn
-from typing import Any, Optional
+import orjson
+from typing import Any, List, Optional, Union
+from proxy import (
+    EMBEDDING_BATCH_MAX_ITEMS,
+    RETRY_STATUS,
+    SINGLE_FLIGHT_MODE,
+    UPSTREAM_MAX_RETRIES,
+    Gauge,
+    Hedger,
+    MicroBatcher,
+    ProxyMetrics,
+    RateLimiters,
+    ResponseCache,
+    SingleFlight,
+    UpstreamError,
+    UpstreamPool,
+    UpstreamResult,
+    backoff_delay,
+    canonical_json,
+    content_key,
+    is_deterministic,
+    parse_priority,
+)
 load_dotenv()
 
 BEARER_TOKEN = {
     "vnptai-hackathon-small": os.getenv("SMALL_BEARER_TOKEN"),
     "vnptai-hackathon-large": os.getenv("LARGE_BEARER_TOKEN"),
+    "vnptai-hackathon-embedding": os.getenv("EMBEDDING_BEARER_TOKEN"),
 }
 
 TOKEN_ID = {
     "vnptai-hackathon-small": os.getenv("SMALL_TOKEN_ID"),
     "vnptai-hackathon-large": os.getenv("LARGE_TOKEN_ID"),
+    "vnptai-hackathon-embedding": os.getenv("EMBEDDING_TOKEN_ID"),
 }
 
 TOKEN_KEY = {
     "vnptai-hackathon-small": os.getenv("SMALL_TOKEN_KEY"),
     "vnptai-hackathon-large": os.getenv("LARGE_TOKEN_KEY"),
+    "vnptai-hackathon-embedding": os.getenv("EMBEDDING_TOKEN_KEY"),
 }
 
 BASE_URL = os.getenv("BASE_URL")
+EMBEDDING_MODEL = "vnptai-hackathon-embedding"
 
-app = FastAPI()
+metrics = ProxyMetrics()
+pool = UpstreamPool(metrics)
+cache = ResponseCache()
+inflight = SingleFlight()
+limiters = RateLimiters()
+hedger = Hedger()
+metrics.register(Gauge(
+    "model_api_response_cache", "Response cache counters and size.",
+    lambda: {(k,): v for k, v in cache.stats().items()}, ("stat",)))
+metrics.register(Gauge(
+    "model_api_single_flight", "Coalesced in-flight request counters.",
+    lambda: {(k,): v for k, v in inflight.stats().items()}, ("stat",)))
+metrics.register(Gauge(
+    "model_api_hedging", "Hedged request counters.",
+    lambda: {(k,): v for k, v in hedger.stats().items()}, ("stat",)))
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    yield
+    await pool.aclose()
+    cache.close()
+
+app = FastAPI(lifespan=lifespan)
 
 class ChatRequest(BaseModel, extra="allow"):
     messages: Any
@@ -43,65 +95,275 @@ class ChatRequest(BaseModel, extra="allow"):
     tool_choice: Optional[Any] = None
     logprobs: Optional[bool] = None
     top_logprobs: Optional[int] = None
+    stream: Optional[bool] = None
+    stream_options: Optional[Any] = None
     extra_fields: dict | None = None
 
-@app.post("/chat/completions")
-async def chat(request: ChatRequest):
-    model = request.model
-    messages = request.messages
-    temperature = request.temperature
-    top_p = request.top_p
-    top_k = request.top_k
-    n = request.n
-    stop = request.stop
-    max_completion_tokens = request.max_completion_tokens
-    presence_penalty = request.presence_penalty
-    frequency_penalty = request.frequency_penalty
-    response_format = request.response_format
-    seed = request.seed
-    tools = request.tools
-    tool_choice = request.tool_choice
-    logprobs = request.logprobs
-    top_logprobs = request.top_logprobs
-
-    kwargs = request.extra_fields if request.extra_fields else {}
+# Keys forwarded upstream, anything else in the body is dropped
+CHAT_FIELDS = tuple(f for f in ChatRequest.model_fields if f != "extra_fields")
+# Fields routing and the response cache read from the unvalidated body
+CHAT_FIELD_TYPES = {
+    "model": str,
+    "messages": list,
+    "temperature": (int, float),
+    "seed": int,
+    "stream": bool,
+}
+
+def chat_type_error(data: dict) -> Optional[str]:
+    for field, types in CHAT_FIELD_TYPES.items():
+        value = data.get(field)
+        if value is None:
+            continue
+        # bool is an int subclass but never a valid temperature or seed
+        if not isinstance(value, types) or (types is not bool and isinstance(value, bool)):
+            return f"`{field}` has the wrong type"
+    return None
 
+def upstream_headers(model: str) -> dict:
     headers = {
-        "Authorization": f"Bearer {BEARER_TOKEN[model]}",
+        "Authorization": f"Bearer {BEARER_TOKEN[model]}" if BEARER_TOKEN[model] else None,
         "Token-id": TOKEN_ID[model],
         "Token-key": TOKEN_KEY[model],
         "Content-Type": "application/json"
     }
+    # httpx rejects None values, credentials missing from the env are left out
+    return {k: v for k, v in headers.items() if v is not None}
 
-    json_data = {
-        "model": model.replace("-", "_"),
-        "messages": messages,
-        "temperature": temperature,
-        "top_p": top_p,
-        "top_k": top_k,
-        "n": n,
-        "stop": stop,
-        "max_completion_tokens": max_completion_tokens,
-        "presence_penalty": presence_penalty,
-        "frequency_penalty": frequency_penalty,
-        "response_format": response_format,
-        "seed": seed,
-        "tools": tools,
-        "tool_choice": tool_choice,
-        "logprobs": logprobs,
-        "top_logprobs": top_logprobs,
-    }
-    res = requests.post(
-        f"{BASE_URL}/v1/chat/completions/{model}",
-        headers=headers,
-        json=json_data
+def error_response(status_code: int, detail: str) -> Response:
+    return Response(
+        content=orjson.dumps({"detail": detail}),
+        status_code=status_code,
+        media_type="application/json"
     )
 
+@app.post("/chat/completions")
+async def chat(request: Request, x_priority: Optional[str] = Header(None)):
+    # The raw body is decoded with orjson instead of being validated into ChatRequest
+    try:
+        data = orjson.loads(await request.body())
+        model = data["model"]
+        data["messages"]
+    except (orjson.JSONDecodeError, KeyError, TypeError):
+        return error_response(422, "Body must be a JSON object with `model` and `messages`")
+    type_error = chat_type_error(data)
+    if type_error is not None:
+        return error_response(422, type_error)
+    if model not in BEARER_TOKEN:
+        return error_response(400, f"Unknown model {model!r}")
+
+    response = await _chat(data, model, parse_priority(x_priority))
+    metrics.requests.inc(route="chat", model=model, status=response.status_code)
+    return response
+
+async def _chat(data: dict, model: str, priority: int):
+    headers = upstream_headers(model)
+
+    # Null-valued keys are left out instead of being sent as explicit nulls
+    json_data = {k: data[k] for k in CHAT_FIELDS if data.get(k) is not None}
+    json_data["model"] = model.replace("-", "_")
+    if not json_data.get("stream"):
+        json_data.pop("stream", None)
+        json_data.pop("stream_options", None)
+
+    content = canonical_json(json_data)
+    if json_data.get("stream"):
+        return await chat_stream(model, headers, content, priority)
+
+    deterministic = is_deterministic(json_data)
+    key = content_key(content)
+    if deterministic:
+        cached = await cache.aget(key)
+        if cached is not None:
+            return Response(
+                content=cached.content,
+                status_code=cached.status_code,
+                media_type=cached.media_type,
+                headers={"X-Cache": "HIT"}
+            )
+
+    async def call():
+        return await post_upstream(
+            model, f"{BASE_URL}/v1/chat/completions/{model}", headers, content, priority
+        )
+
+    async def fetch():
+        # Only deterministic requests can be duplicated without changing the answer
+        if deterministic and hedger.enabled(model):
+            res = await hedger.run(model, call, accept=lambda r: r.status_code == 200)
+        else:
+            res = await call()
+        if deterministic and res.status_code == 200:
+            cache.aput(key, res)
+        return res
+
+    if SINGLE_FLIGHT_MODE == "all" or (SINGLE_FLIGHT_MODE == "deterministic" and deterministic):
+        res = await inflight.do(key, fetch)
+    else:
+        res = await fetch()
+
     return Response(
         content=res.content,
         status_code=res.status_code,
-        media_type=res.headers.get("Content-Type", "application/json")
+        media_type=res.media_type
+    )
+
+async def post_upstream(
+    model: str, url: str, headers: dict, content: bytes, priority: int
+) -> UpstreamResult:
+    limiter = limiters.get(model)
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        await acquire(limiter, model, priority)
+        try:
+            res = await pool.post(model, url, headers=headers, priority=priority, content=content)
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # Nothing reached the upstream, safe to retry
+            res = UpstreamResult(502, f"Upstream error: {e!r}".encode(), "text/plain")
+        except httpx.TimeoutException as e:
+            # A read timeout already cost the full timeout, do not retry it
+            return UpstreamResult(504, f"Upstream timeout: {e!r}".encode(), "text/plain")
+        except httpx.TransportError as e:
+            return UpstreamResult(502, f"Upstream error: {e!r}".encode(), "text/plain")
+
+        if res.status_code not in RETRY_STATUS or attempt == UPSTREAM_MAX_RETRIES:
+            return res
+
+        delay = backoff_delay(attempt, res.retry_after)
+        if res.status_code == 429:
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+
+async def acquire(limiter, model: str, priority: int):
+    queued = time.perf_counter()
+    await limiter.acquire(priority)
+    metrics.queue_wait.observe(time.perf_counter() - queued, model=model, stage="limiter")
+
+@app.get("/cache/stats")
+async def cache_stats():
+    return {**cache.stats(), "single_flight": inflight.stats()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    return Response(content=metrics.render(), media_type="text/plain; version=0.0.4")
+
+async def chat_stream(model: str, headers: dict, content: bytes, priority: int):
+    limiter = limiters.get(model)
+    for attempt in range(UPSTREAM_MAX_RETRIES + 1):
+        await acquire(limiter, model, priority)
+        try:
+            res = await pool.stream(
+                model,
+                f"{BASE_URL}/v1/chat/completions/{model}",
+                headers=headers,
+                priority=priority,
+                content=content
+            )
+        except (httpx.ConnectError, httpx.ConnectTimeout) as e:
+            # Nothing reached the upstream, safe to retry
+            if attempt == UPSTREAM_MAX_RETRIES:
+                return Response(content=f"Upstream error: {e!r}", status_code=502)
+            await asyncio.sleep(backoff_delay(attempt))
+            continue
+        except httpx.TimeoutException as e:
+            return Response(content=f"Upstream timeout: {e!r}", status_code=504)
+        except httpx.TransportError as e:
+            return Response(content=f"Upstream error: {e!r}", status_code=502)
+
+        if res.status_code == 200:
+            return StreamingResponse(
+                res.body,
+                status_code=res.status_code,
+                media_type=res.media_type,
+                headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+            )
+
+        # Errors are not event streams, relay them in one piece
+        body = await res.read()
+        if res.status_code not in RETRY_STATUS or attempt == UPSTREAM_MAX_RETRIES:
+            return Response(content=body, status_code=res.status_code, media_type=res.media_type)
+
+        delay = backoff_delay(attempt, res.retry_after)
+        if res.status_code == 429:
+            limiter.pause(delay)
+        await asyncio.sleep(delay)
+
+class EmbeddingRequest(BaseModel, extra="allow"):
+    input: Union[str, List[str]]
+    model: str = EMBEDDING_MODEL
+    encoding_format: Optional[str] = "float"
+
+def embedding_headers():
+    return upstream_headers(EMBEDDING_MODEL)
+
+async def post_embeddings(texts: List[str], encoding_format: Optional[str], priority: int) -> UpstreamResult:
+    json_data = {
+        "model": EMBEDDING_MODEL.replace("-", "_"),
+        "input": texts,
+        "encoding_format": encoding_format or "float"
+    }
+    content = canonical_json(json_data)
+    return await inflight.do(
+        content_key(content),
+        lambda: post_upstream(
+            EMBEDDING_MODEL, f"{BASE_URL}/{EMBEDDING_MODEL}", embedding_headers(), content, priority
+        )
     )
 
+async def flush_embeddings(items: List[tuple]) -> List[list]:
+    """Embed the texts of concurrent single-text requests in one upstream call."""
+    texts = [text for text, _ in items]
+    unique = list(dict.fromkeys(texts))
+    metrics.batch_size.observe(len(unique))
+
+    res = await post_embeddings(unique, "float", min(priority for _, priority in items))
+    if res.status_code != 200:
+        raise UpstreamError(res)
+
+    try:
+        data = sorted(orjson.loads(res.content)["data"], key=lambda x: x["index"])
+        embeddings = [item["embedding"] for item in data]
+    except (orjson.JSONDecodeError, KeyError, TypeError) as e:
+        embeddings, detail = None, f"malformed embedding response: {e!r}"
+    else:
+        detail = f"expected {len(unique)} embeddings, got {len(embeddings)}"
+    # A short reply would leave texts of the batch without a vector, fail them all alike
+    if embeddings is None or len(embeddings) != len(unique):
+        raise UpstreamError(UpstreamResult(502, f"Upstream error: {detail}".encode(), "text/plain"))
+
+    by_text = dict(zip(unique, embeddings))
+    return [by_text[text] for text in texts]
+
+embedding_batcher = MicroBatcher(flush_embeddings)
+
+@app.post("/embeddings")
+async def embeddings(request: EmbeddingRequest, x_priority: Optional[str] = Header(None)):
+    response = await _embeddings(request, x_priority)
+    metrics.requests.inc(route="embeddings", model=EMBEDDING_MODEL, status=response.status_code)
+    return response
+
+async def _embeddings(request: EmbeddingRequest, x_priority: Optional[str]):
+    texts = [request.input] if isinstance(request.input, str) else request.input
+    priority = parse_priority(x_priority)
+
+    # Large lists and non-float encodings are already worth a call of their own
+    if len(texts) >= EMBEDDING_BATCH_MAX_ITEMS or request.encoding_format not in (None, "float"):
+        res = await post_embeddings(texts, request.encoding_format, priority)
+        return Response(content=res.content, status_code=res.status_code, media_type=res.media_type)
+
+    try:
+        vectors = await asyncio.gather(*(embedding_batcher.submit((text, priority)) for text in texts))
+    except UpstreamError as e:
+        return Response(content=e.result.content, status_code=e.result.status_code, media_type=e.result.media_type)
+
+    content = orjson.dumps({
+        "object": "list",
+        "model": request.model,
+        "data": [
+            {"object": "embedding", "index": i, "embedding": vector}
+            for i, vector in enumerate(vectors)
+        ]
+    })
+    return Response(content=content, media_type="application/json")
+
 if __name__ == "__main__":
     uvicorn.run("model_api:app", host="0.0.0.0", port=2205)
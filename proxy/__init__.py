@@ -0,0 +1,7 @@
+from .client import *
+from .cache import *
+from .singleflight import *
+from .limiter import *
+from .metrics import *
+from .batcher import *
+from .hedge import *
@@ -0,0 +1,64 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable, List
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+EMBEDDING_BATCH_MAX_ITEMS = int(os.getenv("EMBEDDING_BATCH_MAX_ITEMS", 64))
+EMBEDDING_BATCH_MAX_WAIT = float(os.getenv("EMBEDDING_BATCH_MAX_WAIT", 0.005))  # seconds
+
+
+class MicroBatcher:
+    """Collect items submitted concurrently and flush them as one call.
+
+    A batch is flushed once it holds `max_items` items or `max_wait` seconds after its first item.
+    `flush` receives the items in submission order and must return one result per item.
+    """
+
+    def __init__(
+        self,
+        flush: Callable[[List[Any]], Awaitable[List[Any]]],
+        max_items: int = EMBEDDING_BATCH_MAX_ITEMS,
+        max_wait: float = EMBEDDING_BATCH_MAX_WAIT,
+    ):
+        self.flush = flush
+        self.max_items = max_items
+        self.max_wait = max_wait
+        self._pending = []
+        self._timer = None
+        self._tasks = set()
+
+    async def submit(self, item: Any) -> Any:
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((item, fut))
+        if len(self._pending) >= self.max_items:
+            self._flush_pending()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush_pending)
+        return await fut
+
+    def _flush_pending(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if not batch:
+            return
+        task = asyncio.ensure_future(self._run(batch))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, batch):
+        try:
+            results = await self.flush([item for item, _ in batch])
+        except Exception as e:
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(e)
+            return
+
+        for (_, fut), result in zip(batch, results):
+            if not fut.done():
+                fut.set_result(result)
@@ -0,0 +1,200 @@
+import asyncio
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional
+
+import orjson
+from dotenv import load_dotenv
+
+from .client import UpstreamResult
+
+load_dotenv()
+
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", 256 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 0))  # seconds, 0 = never expire
+RESPONSE_CACHE_PATH = os.getenv("RESPONSE_CACHE_PATH")  # sqlite file, unset = memory only
+
+
+def canonical_json(payload: dict) -> bytes:
+    """Compact JSON with sorted keys, the same payload always encodes to the same bytes."""
+    return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+
+
+def content_key(content: bytes) -> str:
+    return hashlib.sha256(content).hexdigest()
+
+
+def request_key(payload: dict) -> str:
+    """Canonical hash of a request payload, independent of key order."""
+    return content_key(canonical_json(payload))
+
+
+def is_deterministic(payload: dict) -> bool:
+    if payload.get("stream"):
+        return False
+    return payload.get("temperature") == 0 or payload.get("seed") is not None
+
+
+class ResponseCache:
+    """In-memory LRU bounded by bytes, backed by an optional sqlite store.
+
+    `aget` / `aput` keep sqlite off the event loop: reads run in a thread, writes are
+    queued to a single background writer.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        ttl: float = RESPONSE_CACHE_TTL,
+        path: Optional[str] = RESPONSE_CACHE_PATH,
+    ):
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.disk_hits = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        # Separate from the LRU lock, a sqlite call in a thread never stalls a memory lookup on the loop
+        self._db_lock = threading.Lock()
+        self._db = None
+        self._writer = None
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self._db = sqlite3.connect(path, check_same_thread=False)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            # Cached responses can be refetched, no fsync per commit
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, created REAL, status_code INTEGER, "
+                "media_type TEXT, content BLOB)"
+            )
+            self._db.commit()
+            self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="response-cache")
+
+    def _expired(self, created: float) -> bool:
+        return self.ttl > 0 and time.time() - created > self.ttl
+
+    def get(self, key: str) -> Optional[UpstreamResult]:
+        result = self._get_memory(key)
+        if result is None and self._db is not None:
+            result = self._get_disk(key)
+        return self._count(result)
+
+    async def aget(self, key: str) -> Optional[UpstreamResult]:
+        result = self._get_memory(key)
+        if result is None and self._db is not None:
+            result = await asyncio.to_thread(self._get_disk, key)
+        return self._count(result)
+
+    def put(self, key: str, result: UpstreamResult):
+        created = time.time()
+        self._put_memory(key, created, result)
+        if self._db is not None:
+            self._put_disk(key, created, result)
+
+    def aput(self, key: str, result: UpstreamResult):
+        """Store in memory now, the sqlite write is queued and not waited for."""
+        created = time.time()
+        self._put_memory(key, created, result)
+        if self._writer is not None:
+            self._writer.submit(self._put_disk, key, created, result)
+
+    def _get_memory(self, key: str) -> Optional[UpstreamResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            created, result = entry
+            if self._expired(created):
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return result
+
+    def _get_disk(self, key: str) -> Optional[UpstreamResult]:
+        with self._db_lock:
+            if self._db is None:
+                return None
+            row = self._db.execute(
+                "SELECT created, status_code, media_type, content FROM responses WHERE key = ?",
+                (key,),
+            ).fetchone()
+        if row is None or self._expired(row[0]):
+            return None
+        result = UpstreamResult(status_code=row[1], media_type=row[2], content=row[3])
+        with self._lock:
+            self._insert(key, row[0], result)
+            self.disk_hits += 1
+            return result
+
+    def _count(self, result: Optional[UpstreamResult]) -> Optional[UpstreamResult]:
+        with self._lock:
+            if result is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return result
+
+    def _put_memory(self, key: str, created: float, result: UpstreamResult):
+        with self._lock:
+            self._insert(key, created, result)
+
+    def _put_disk(self, key: str, created: float, result: UpstreamResult):
+        with self._db_lock:
+            if self._db is None:
+                return
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, created, result.status_code, result.media_type, result.content),
+            )
+            self._db.commit()
+
+    def _insert(self, key: str, created: float, result: UpstreamResult):
+        size = len(result.content)
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        self._entries[key] = (created, result)
+        self._bytes += size
+        while self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        _, result = self._entries.pop(key)
+        self._bytes -= len(result.content)
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "disk_hits": self.disk_hits,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+    def close(self):
+        if self._writer is not None:
+            # Let queued writes land before the connection goes away
+            self._writer.shutdown(wait=True)
+            self._writer = None
+        with self._db_lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,192 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator, Optional
+
+import httpx
+from dotenv import load_dotenv
+
+from .limiter import PRIORITY_INTERACTIVE, PrioritySemaphore
+
+load_dotenv()
+
+UPSTREAM_CONNECT_TIMEOUT = float(os.getenv("UPSTREAM_CONNECT_TIMEOUT", 10))
+UPSTREAM_READ_TIMEOUT = float(os.getenv("UPSTREAM_READ_TIMEOUT", 300))
+
+# Keep-alive connections opened per model
+MAX_CONNECTIONS = {
+    "vnptai-hackathon-small": int(os.getenv("SMALL_MAX_CONNECTIONS", 64)),
+    "vnptai-hackathon-large": int(os.getenv("LARGE_MAX_CONNECTIONS", 32)),
+}
+
+# Requests allowed in flight per model, the rest wait on the semaphore in priority order
+MAX_CONCURRENCY = {
+    "vnptai-hackathon-small": int(os.getenv("SMALL_MAX_CONCURRENCY", 64)),
+    "vnptai-hackathon-large": int(os.getenv("LARGE_MAX_CONCURRENCY", 32)),
+}
+
+DEFAULT_MAX_CONNECTIONS = int(os.getenv("DEFAULT_MAX_CONNECTIONS", 32))
+DEFAULT_MAX_CONCURRENCY = int(os.getenv("DEFAULT_MAX_CONCURRENCY", 32))
+
+# Bytes of a stream kept to read the final usage event from
+STREAM_TAIL_BYTES = 8192
+
+
+def parse_retry_after(value: Optional[str]) -> Optional[float]:
+    """Retry-After is either delta-seconds or an HTTP date."""
+    if not value:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return parsedate_to_datetime(value).timestamp() - time.time()
+    except (TypeError, ValueError):
+        return None
+
+
+@dataclass(frozen=True)
+class UpstreamResult:
+    status_code: int
+    content: bytes
+    media_type: str
+    retry_after: Optional[float] = None
+
+
+class UpstreamError(Exception):
+    """Raised where a non-200 upstream reply has to cross a batch boundary."""
+
+    def __init__(self, result: UpstreamResult):
+        super().__init__(f"Upstream returned {result.status_code}")
+        self.result = result
+
+
+@dataclass(frozen=True)
+class UpstreamStream:
+    status_code: int
+    media_type: str
+    body: AsyncIterator[bytes]
+    retry_after: Optional[float] = None
+
+    async def read(self) -> bytes:
+        return b"".join([chunk async for chunk in self.body])
+
+
+class UpstreamPool:
+    """Shared httpx clients, one keep-alive pool and one semaphore per model."""
+
+    def __init__(self, metrics=None):
+        self.metrics = metrics
+        self._clients = {}
+        self._semaphores = {}
+
+    def client(self, model: str) -> httpx.AsyncClient:
+        if model not in self._clients:
+            max_connections = MAX_CONNECTIONS.get(model, DEFAULT_MAX_CONNECTIONS)
+            self._clients[model] = httpx.AsyncClient(
+                timeout=httpx.Timeout(
+                    UPSTREAM_READ_TIMEOUT,
+                    connect=UPSTREAM_CONNECT_TIMEOUT,
+                    pool=None,
+                ),
+                limits=httpx.Limits(
+                    max_connections=max_connections,
+                    max_keepalive_connections=max_connections,
+                ),
+            )
+        return self._clients[model]
+
+    def semaphore(self, model: str) -> PrioritySemaphore:
+        if model not in self._semaphores:
+            self._semaphores[model] = PrioritySemaphore(
+                MAX_CONCURRENCY.get(model, DEFAULT_MAX_CONCURRENCY)
+            )
+        return self._semaphores[model]
+
+    async def post(
+        self, model: str, url: str, headers: dict, priority: int = PRIORITY_INTERACTIVE, **kwargs
+    ) -> UpstreamResult:
+        client = self.client(model)
+        req = client.build_request("POST", url, headers=headers, **kwargs)
+
+        semaphore = self.semaphore(model)
+        queued = time.perf_counter()
+        await semaphore.acquire(priority)
+        started = time.perf_counter()
+        res = None
+        try:
+            res = await client.send(req)
+        finally:
+            semaphore.release()
+            self._observe(model, req, queued, started, res)
+
+        result = UpstreamResult(
+            status_code=res.status_code,
+            content=res.content,
+            media_type=res.headers.get("Content-Type", "application/json"),
+            retry_after=parse_retry_after(res.headers.get("Retry-After")),
+        )
+        if self.metrics is not None and res.status_code == 200:
+            self.metrics.record_response(model, result.content)
+        return result
+
+    async def stream(
+        self, model: str, url: str, headers: dict, priority: int = PRIORITY_INTERACTIVE, **kwargs
+    ) -> UpstreamStream:
+        """Send a request and relay the body as it arrives.
+
+        The concurrency slot is held until the body iterator is exhausted or closed.
+        """
+        client = self.client(model)
+        req = client.build_request("POST", url, headers=headers, **kwargs)
+
+        semaphore = self.semaphore(model)
+        queued = time.perf_counter()
+        await semaphore.acquire(priority)
+        started = time.perf_counter()
+        try:
+            res = await client.send(req, stream=True)
+        except BaseException:
+            semaphore.release()
+            self._observe(model, req, queued, started, None)
+            raise
+        self._observe(model, req, queued, started, res)
+
+        async def body():
+            size = 0
+            tail = b""
+            try:
+                async for chunk in res.aiter_bytes():
+                    size += len(chunk)
+                    tail = (tail + chunk)[-STREAM_TAIL_BYTES:]
+                    yield chunk
+            finally:
+                await res.aclose()
+                semaphore.release()
+                if self.metrics is not None and res.status_code == 200:
+                    self.metrics.response_bytes.observe(size, model=model)
+                    self.metrics.record_stream_tail(model, tail)
+
+        return UpstreamStream(
+            status_code=res.status_code,
+            media_type=res.headers.get("Content-Type", "text/event-stream"),
+            body=body(),
+            retry_after=parse_retry_after(res.headers.get("Retry-After")),
+        )
+
+    def _observe(self, model: str, req: httpx.Request, queued: float, started: float, res):
+        if self.metrics is None:
+            return
+        self.metrics.queue_wait.observe(started - queued, model=model, stage="concurrency")
+        self.metrics.upstream_latency.observe(time.perf_counter() - started, model=model)
+        self.metrics.request_bytes.observe(len(req.content), model=model)
+        status = res.status_code if res is not None else "error"
+        self.metrics.upstream_requests.inc(model=model, status=status)
+
+    async def aclose(self):
+        clients = list(self._clients.values())
+        self._clients.clear()
+        await asyncio.gather(*(c.aclose() for c in clients))
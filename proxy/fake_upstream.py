@@ -0,0 +1,143 @@
+"""Local stand-in for the hackathon upstream, for load-testing model_api without spending quota.
+
+    python -m proxy.fake_upstream --port 2300 --latency 1.5 --error-rate 0.01
+    BASE_URL=http://localhost:2300 python model_api.py
+"""
+import argparse
+import asyncio
+import random
+import time
+import uuid
+
+import orjson
+import uvicorn
+from fastapi import FastAPI, Request, Response
+from fastapi.responses import StreamingResponse
+
+CONFIG = {
+    "latency": 1.0,          # median chat latency, seconds
+    "latency_sigma": 0.5,    # lognormal spread, the tail grows fast above ~0.8
+    "embedding_latency": 0.05,
+    "error_rate": 0.0,       # share of 500 replies
+    "throttle_rate": 0.0,    # share of 429 replies
+    "retry_after": 1,
+    "completion_tokens": 200,
+    "embedding_dim": 1024,
+}
+
+app = FastAPI()
+
+
+def sample_latency(median: float) -> float:
+    return random.lognormvariate(0, CONFIG["latency_sigma"]) * median
+
+
+def injected_error():
+    roll = random.random()
+    if roll < CONFIG["throttle_rate"]:
+        return Response(
+            content=b'{"error": "rate limited"}',
+            status_code=429,
+            media_type="application/json",
+            headers={"Retry-After": str(CONFIG["retry_after"])},
+        )
+    if roll < CONFIG["throttle_rate"] + CONFIG["error_rate"]:
+        return Response(content=b'{"error": "injected"}', status_code=500, media_type="application/json")
+    return None
+
+
+def prompt_tokens(messages) -> int:
+    return sum(len(str(m.get("content", ""))) for m in messages or []) // 4
+
+
+@app.post("/v1/chat/completions/{model}")
+async def chat(model: str, request: Request):
+    body = orjson.loads(await request.body())
+    error = injected_error()
+    if error is not None:
+        await asyncio.sleep(sample_latency(CONFIG["latency"]) / 10)
+        return error
+
+    n_tokens = CONFIG["completion_tokens"]
+    words = ["token"] * n_tokens
+    usage = {
+        "prompt_tokens": prompt_tokens(body.get("messages")),
+        "completion_tokens": n_tokens,
+    }
+    usage["total_tokens"] = usage["prompt_tokens"] + n_tokens
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    latency = sample_latency(CONFIG["latency"])
+
+    if body.get("stream"):
+        async def events():
+            step = latency / max(1, n_tokens)
+            for word in words:
+                await asyncio.sleep(step)
+                chunk = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "model": body.get("model"),
+                    "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+                }
+                yield b"data: " + orjson.dumps(chunk) + b"\n\n"
+            final = {"id": completion_id, "object": "chat.completion.chunk", "choices": [], "usage": usage}
+            yield b"data: " + orjson.dumps(final) + b"\n\n"
+            yield b"data: [DONE]\n\n"
+
+        return StreamingResponse(events(), media_type="text/event-stream")
+
+    await asyncio.sleep(latency)
+    return Response(
+        content=orjson.dumps({
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": body.get("model"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": " ".join(words)},
+                "finish_reason": "stop",
+            }],
+            "usage": usage,
+        }),
+        media_type="application/json",
+    )
+
+
+@app.post("/vnptai-hackathon-embedding")
+async def embedding(request: Request):
+    body = orjson.loads(await request.body())
+    error = injected_error()
+    if error is not None:
+        return error
+
+    texts = body["input"] if isinstance(body["input"], list) else [body["input"]]
+    # Per-call overhead dominates, batches only pay a little extra per text
+    await asyncio.sleep(sample_latency(CONFIG["embedding_latency"]) * (1 + len(texts) / 256))
+
+    dim = CONFIG["embedding_dim"]
+    data = []
+    for i, text in enumerate(texts):
+        rng = random.Random(text)
+        data.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(dim)]})
+    return Response(
+        content=orjson.dumps({"object": "list", "data": data, "model": body.get("model")}),
+        media_type="application/json",
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=2300)
+    for key, value in CONFIG.items():
+        parser.add_argument(f"--{key.replace('_', '-')}", type=type(value), default=value)
+    args = parser.parse_args()
+    for key in CONFIG:
+        CONFIG[key] = getattr(args, key)
+
+    uvicorn.run(app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Optional
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# Comma separated models hedging is enabled for, e.g. "vnptai-hackathon-large"
+HEDGE_MODELS = {m.strip() for m in os.getenv("HEDGE_MODELS", "").split(",") if m.strip()}
+HEDGE_QUANTILE = float(os.getenv("HEDGE_QUANTILE", 0.95))
+HEDGE_MIN_DELAY = float(os.getenv("HEDGE_MIN_DELAY", 1.0))  # seconds
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", 0.05))  # hedges per request
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", 50))
+HEDGE_WINDOW = int(os.getenv("HEDGE_WINDOW", 500))
+
+
+class Hedger:
+    """Send a backup request when the first one is slower than the recent latency quantile.
+
+    Each request adds `max_ratio` to a budget and each hedge spends 1 from it,
+    so hedges never exceed that share of traffic.
+    """
+
+    def __init__(
+        self,
+        models=HEDGE_MODELS,
+        quantile: float = HEDGE_QUANTILE,
+        min_delay: float = HEDGE_MIN_DELAY,
+        max_ratio: float = HEDGE_MAX_RATIO,
+        min_samples: int = HEDGE_MIN_SAMPLES,
+        window: int = HEDGE_WINDOW,
+    ):
+        self.models = set(models)
+        self.quantile = quantile
+        self.min_delay = min_delay
+        self.max_ratio = max_ratio
+        self.min_samples = min_samples
+        self.window = window
+        self.requests = 0
+        self.hedged = 0
+        self.backup_wins = 0
+        self._budget = 0.0
+        self._latencies = {}
+
+    def enabled(self, model: str) -> bool:
+        return model in self.models
+
+    def delay(self, model: str) -> Optional[float]:
+        samples = self._latencies.get(model)
+        if not samples or len(samples) < self.min_samples:
+            return None
+        ordered = sorted(samples)
+        return max(self.min_delay, ordered[int(self.quantile * (len(ordered) - 1))])
+
+    def record(self, model: str, seconds: float):
+        self._latencies.setdefault(model, deque(maxlen=self.window)).append(seconds)
+
+    async def run(
+        self,
+        model: str,
+        fn: Callable[[], Awaitable[Any]],
+        accept: Callable[[Any], bool] = lambda _: True,
+    ) -> Any:
+        self.requests += 1
+        self._budget = min(10.0, self._budget + self.max_ratio)
+        delay = self.delay(model)
+
+        started = time.perf_counter()
+        primary = asyncio.ensure_future(fn())
+        tasks = {primary}
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and self._budget >= 1:
+                self._budget -= 1
+                self.hedged += 1
+                tasks.add(asyncio.ensure_future(fn()))
+
+            # First accepted result wins, otherwise fall back to whichever finished last
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                # The quantile tracks the primary whether it wins or not, backups start late
+                if primary in done:
+                    self.record(model, time.perf_counter() - started)
+                for task in done:
+                    if task.exception() is None and accept(task.result()):
+                        if task is not primary:
+                            self.backup_wins += 1
+                        return task.result()
+            return task.result()
+        finally:
+            if not primary.done() and len(tasks) > 1:
+                # Cancelled after the backup won, it took at least this long
+                self.record(model, time.perf_counter() - started)
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        return {
+            "requests": self.requests,
+            "hedged": self.hedged,
+            "backup_wins": self.backup_wins,
+        }
@@ -0,0 +1,169 @@
+import asyncio
+import heapq
+import itertools
+import os
+import random
+import time
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BATCH = 1
+PRIORITIES = {
+    "interactive": PRIORITY_INTERACTIVE,
+    "batch": PRIORITY_BATCH,
+}
+
+# Requests per second and burst size per model, rate 0 = unlimited
+RATE_LIMIT = {
+    "vnptai-hackathon-small": float(os.getenv("SMALL_RATE_LIMIT", 0)),
+    "vnptai-hackathon-large": float(os.getenv("LARGE_RATE_LIMIT", 0)),
+    "vnptai-hackathon-embedding": float(os.getenv("EMBEDDING_RATE_LIMIT", 0)),
+}
+RATE_BURST = {
+    "vnptai-hackathon-small": int(os.getenv("SMALL_RATE_BURST", 8)),
+    "vnptai-hackathon-large": int(os.getenv("LARGE_RATE_BURST", 4)),
+    "vnptai-hackathon-embedding": int(os.getenv("EMBEDDING_RATE_BURST", 8)),
+}
+
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", 4))
+UPSTREAM_BACKOFF_BASE = float(os.getenv("UPSTREAM_BACKOFF_BASE", 0.5))
+UPSTREAM_BACKOFF_MAX = float(os.getenv("UPSTREAM_BACKOFF_MAX", 30))
+RETRY_STATUS = {429, 500, 502, 503, 504}
+
+
+def parse_priority(value) -> int:
+    if value is None:
+        return PRIORITY_INTERACTIVE
+    if value in PRIORITIES:
+        return PRIORITIES[value]
+    try:
+        return int(value)
+    except ValueError:
+        return PRIORITY_INTERACTIVE
+
+
+def backoff_delay(attempt: int, retry_after=None) -> float:
+    """Full-jitter exponential backoff, or the server's Retry-After when given."""
+    if retry_after is not None:
+        return min(max(retry_after, 0.0), UPSTREAM_BACKOFF_MAX)
+    return random.uniform(0, min(UPSTREAM_BACKOFF_MAX, UPSTREAM_BACKOFF_BASE * 2 ** attempt))
+
+
+class PriorityRateLimiter:
+    """Token bucket whose waiters are served lowest priority value first, FIFO within a priority."""
+
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = max(1, burst)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._waiters = []
+        self._seq = itertools.count()
+        self._wakeup = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        if self.rate <= 0:
+            return
+
+        self._refill()
+        if not self._waiters and self._tokens >= 1:
+            self._tokens -= 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._schedule()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Granted right before the cancellation: hand the token back
+            if fut.done() and not fut.cancelled():
+                self._tokens += 1
+            raise
+
+    def pause(self, seconds: float):
+        """Stop granting tokens for `seconds`, e.g. after an upstream 429."""
+        if self.rate <= 0:
+            return
+        self._refill()
+        self._tokens = min(self._tokens, -self.rate * seconds)
+
+    def _dispatch(self):
+        self._wakeup = None
+        self._refill()
+        while self._waiters and self._tokens >= 1:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._tokens -= 1
+            fut.set_result(None)
+        self._schedule()
+
+    def _schedule(self):
+        while self._waiters and self._waiters[0][2].done():
+            heapq.heappop(self._waiters)
+        if self._waiters and self._wakeup is None:
+            delay = max(0.0, (1 - self._tokens) / self.rate)
+            self._wakeup = asyncio.get_running_loop().call_later(delay, self._dispatch)
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+
+class PrioritySemaphore:
+    """Concurrency gate whose waiters are served lowest priority value first, FIFO within a priority."""
+
+    def __init__(self, value: int):
+        self._value = max(1, value)
+        self._waiters = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE):
+        # A free slot is never left while someone waits, release() hands it over first
+        if self._value > 0:
+            self._value -= 1
+            return
+
+        fut = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Granted right before the cancellation: pass the slot on
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self._value += 1
+        while self._waiters and self._value > 0:
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            self._value -= 1
+            fut.set_result(None)
+
+    @property
+    def waiting(self) -> int:
+        return sum(1 for _, _, fut in self._waiters if not fut.done())
+
+
+class RateLimiters:
+    def __init__(self):
+        self._limiters = {}
+
+    def get(self, model: str) -> PriorityRateLimiter:
+        if model not in self._limiters:
+            self._limiters[model] = PriorityRateLimiter(
+                RATE_LIMIT.get(model, 0), RATE_BURST.get(model, 1)
+            )
+        return self._limiters[model]
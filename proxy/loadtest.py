@@ -0,0 +1,130 @@
+"""Replay data/val.json-shaped prompts against model_api and report throughput and latency.
+
+    python -m proxy.loadtest --url http://localhost:2205 --concurrency 32 --requests 500
+    python -m proxy.loadtest --route embeddings --concurrency 128 --output bench.jsonl
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import subprocess
+import time
+from collections import Counter
+
+import httpx
+
+
+def load_prompts(path: str):
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    prompts = []
+    for item in data:
+        choices = "\n".join(f"{chr(ord('A') + i)}. {c}" for i, c in enumerate(item["choices"]))
+        prompts.append(f"{item['question']}\n{choices}")
+    return prompts
+
+
+def percentile(values, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def build_request(args, prompt: str, i: int):
+    if args.route == "embeddings":
+        return "/embeddings", {"input": prompt[:2000]}
+
+    body = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": prompt}],
+        "temperature": args.temperature,
+        "max_completion_tokens": args.max_tokens,
+    }
+    if args.unique:
+        # Defeat the response cache and single-flight by making every request distinct
+        body["messages"].insert(0, {"role": "system", "content": f"run {i}"})
+    if args.stream:
+        body["stream"] = True
+    return "/chat/completions", body
+
+
+async def run(args):
+    prompts = load_prompts(args.data)
+    latencies = []
+    statuses = Counter()
+    counter = itertools.count()
+    headers = {"X-Priority": args.priority}
+
+    limits = httpx.Limits(max_connections=args.concurrency, max_keepalive_connections=args.concurrency)
+    async with httpx.AsyncClient(base_url=args.url, limits=limits, timeout=args.timeout) as client:
+
+        async def worker():
+            while True:
+                i = next(counter)
+                if i >= args.requests:
+                    return
+                path, body = build_request(args, prompts[i % len(prompts)], i)
+                started = time.perf_counter()
+                try:
+                    res = await client.post(path, json=body, headers=headers)
+                    await res.aread()
+                    statuses[res.status_code] += 1
+                except httpx.HTTPError as e:
+                    statuses[type(e).__name__] += 1
+                    continue
+                latencies.append(time.perf_counter() - started)
+
+        started = time.perf_counter()
+        await asyncio.gather(*(worker() for _ in range(args.concurrency)))
+        elapsed = time.perf_counter() - started
+
+    return {
+        "route": args.route,
+        "model": args.model,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "elapsed": round(elapsed, 3),
+        "throughput": round(args.requests / elapsed, 2),
+        "p50": round(percentile(latencies, 0.50), 4),
+        "p95": round(percentile(latencies, 0.95), 4),
+        "p99": round(percentile(latencies, 0.99), 4),
+        "statuses": {str(k): v for k, v in statuses.items()},
+    }
+
+
+def git_revision() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:2205")
+    parser.add_argument("--route", choices=["chat", "embeddings"], default="chat")
+    parser.add_argument("--model", default="vnptai-hackathon-small")
+    parser.add_argument("--data", default="./data/val.json")
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    parser.add_argument("--temperature", type=float, default=0.0)
+    parser.add_argument("--max-tokens", type=int, default=512)
+    parser.add_argument("--priority", default="batch")
+    parser.add_argument("--timeout", type=float, default=600)
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument("--unique", action="store_true", help="make every request distinct")
+    parser.add_argument("--output", help="append the result as a JSON line, tagged with the git revision")
+    args = parser.parse_args()
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=4))
+
+    if args.output:
+        with open(args.output, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"revision": git_revision(), **result}) + "\n")
+
+
+if __name__ == "__main__":
+    main()
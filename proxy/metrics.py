@@ -0,0 +1,155 @@
+import bisect
+import threading
+from typing import Callable, Dict, Optional, Tuple
+
+import orjson
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 40, 80, 160, 320)
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BATCH_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128, 256, 512, 1024)
+BYTES_BUCKETS = (256, 1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self._values: Dict[Tuple[str, ...], float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, _format_labels(self.labels, k), v) for k, v in self._values.items()]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, buckets: Tuple[float, ...], labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple[str, ...], list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels):
+        key = tuple(str(labels[n]) for n in self.labels)
+        with self._lock:
+            # [per-bucket counts..., +Inf count, sum]
+            state = self._values.setdefault(key, [0] * (len(self.buckets) + 1) + [0.0])
+            state[bisect.bisect_left(self.buckets, value)] += 1
+            state[-1] += value
+
+    def samples(self):
+        out = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + ("+Inf",), state[:-1]):
+                    cumulative += count
+                    le = f'le="{bound}"'
+                    out.append((f"{self.name}_bucket", _format_labels(self.labels, key, le), cumulative))
+                out.append((f"{self.name}_count", _format_labels(self.labels, key), cumulative))
+                out.append((f"{self.name}_sum", _format_labels(self.labels, key), state[-1]))
+        return out
+
+
+class Gauge:
+    """Gauge read from a callback at scrape time, returning {label values: value}."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help: str, fn: Callable[[], Dict[Tuple[str, ...], float]],
+                 labels: Tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.fn = fn
+
+    def samples(self):
+        return [(self.name, _format_labels(self.labels, k), v) for k, v in self.fn().items()]
+
+
+class ProxyMetrics:
+    def __init__(self):
+        self._metrics = []
+        self.requests = self.register(Counter(
+            "model_api_requests_total", "Requests served by the proxy.", ("route", "model", "status")))
+        self.upstream_requests = self.register(Counter(
+            "model_api_upstream_requests_total", "Requests sent upstream, including retries.", ("model", "status")))
+        self.upstream_latency = self.register(Histogram(
+            "model_api_upstream_latency_seconds", "Upstream round-trip time.", LATENCY_BUCKETS, ("model",)))
+        self.queue_wait = self.register(Histogram(
+            "model_api_queue_wait_seconds", "Time spent waiting before going upstream.", WAIT_BUCKETS,
+            ("model", "stage")))
+        self.request_bytes = self.register(Histogram(
+            "model_api_request_bytes", "Upstream request body size.", BYTES_BUCKETS, ("model",)))
+        self.response_bytes = self.register(Histogram(
+            "model_api_response_bytes", "Upstream response body size.", BYTES_BUCKETS, ("model",)))
+        self.prompt_tokens = self.register(Counter(
+            "model_api_prompt_tokens_total", "Prompt tokens reported by the upstream usage field.", ("model",)))
+        self.completion_tokens = self.register(Counter(
+            "model_api_completion_tokens_total", "Completion tokens reported by the upstream usage field.",
+            ("model",)))
+        self.batch_size = self.register(Histogram(
+            "model_api_embedding_batch_size", "Texts per batched upstream embedding call.", BATCH_BUCKETS))
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def record_usage(self, model: str, usage: Optional[dict]):
+        if not usage:
+            return
+        self.prompt_tokens.inc(usage.get("prompt_tokens") or 0, model=model)
+        self.completion_tokens.inc(usage.get("completion_tokens") or 0, model=model)
+
+    def record_response(self, model: str, content: bytes):
+        self.response_bytes.observe(len(content), model=model)
+        try:
+            self.record_usage(model, orjson.loads(content).get("usage"))
+        except (orjson.JSONDecodeError, AttributeError):
+            pass
+
+    def record_stream_tail(self, model: str, tail: bytes):
+        """Pick the usage block out of the last SSE events of a stream."""
+        for line in reversed(tail.split(b"\n")):
+            line = line.strip()
+            if not line.startswith(b"data:") or b'"usage"' not in line:
+                continue
+            try:
+                usage = orjson.loads(line[5:]).get("usage")
+            except (orjson.JSONDecodeError, AttributeError):
+                continue
+            if usage:
+                self.record_usage(model, usage)
+                return
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {value}")
+        return "\n".join(lines) + "\n"
@@ -0,0 +1,40 @@
+import asyncio
+import os
+from typing import Any, Awaitable, Callable
+
+from dotenv import load_dotenv
+
+load_dotenv()
+
+# "deterministic" coalesces only cacheable requests, "all" every non-streaming one, "off" disables
+SINGLE_FLIGHT_MODE = os.getenv("SINGLE_FLIGHT_MODE", "deterministic")
+
+
+class SingleFlight:
+    """Coalesce concurrent calls sharing a key into one upstream call.
+
+    The call runs in its own task, so a disconnecting caller does not cancel it for the others.
+    """
+
+    def __init__(self):
+        self._inflight = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Any:
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        return await asyncio.shield(task)
+
+    def stats(self) -> dict:
+        return {
+            "leaders": self.leaders,
+            "coalesced": self.coalesced,
+            "inflight": len(self._inflight),
+        }
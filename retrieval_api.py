@@ -0,0 +1,101 @@
+from fastapi import FastAPI, Response
+import asyncio
+import os
+from contextlib import asynccontextmanager
+from dotenv import load_dotenv
+import uvicorn
+import orjson
+from pydantic import BaseModel
+from typing import List, Optional
+from tools.retrieval import RetrievalTools, embedding_cache_stats, get_engine
+
+load_dotenv()
+
+RETRIEVAL_API_PORT = int(os.getenv("RETRIEVAL_API_PORT", 2206))
+# Metrics to warm up before reporting ready
+RETRIEVAL_WARMUP_METRICS = os.getenv("RETRIEVAL_WARMUP_METRICS", "cosine").split(",")
+
+engine = get_engine()
+warmup = None
+# One toolkit per client configuration, they all share the engine
+toolkits = {}
+
+async def warm_up():
+    for metric in RETRIEVAL_WARMUP_METRICS:
+        await asyncio.to_thread(engine.preload, metric.strip(), True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global warmup
+    warmup = asyncio.create_task(warm_up())
+    yield
+    warmup.cancel()
+
+app = FastAPI(lifespan=lifespan)
+
+class RetrievalSettings(BaseModel):
+    k: int = 10
+    enable_hybrid: bool = True
+    enable_filter: bool = True
+    distance_metric: str = "cosine"
+    pack: bool = True
+    token_budget: Optional[int] = None
+
+class RetrieveRequest(RetrievalSettings):
+    query: str
+    fields: List[str] = []
+    context: int = 0
+
+class RetrieveBatchRequest(RetrievalSettings):
+    queries: List[str]
+    fields: List[str] = []
+    context: int = 0
+
+def json_response(payload, status_code: int = 200) -> Response:
+    return Response(content=orjson.dumps(payload), status_code=status_code, media_type="application/json")
+
+def toolkit(settings: RetrievalSettings) -> RetrievalTools:
+    key = tuple(settings.model_dump(include=set(RetrievalSettings.model_fields)).values())
+    if key not in toolkits:
+        options = settings.model_dump(include=set(RetrievalSettings.model_fields), exclude_none=True)
+        # api_url="" keeps the toolkit local even when RETRIEVAL_API_URL is set here
+        toolkits[key] = RetrievalTools(preload=False, engine=engine, api_url="", **options)
+    return toolkits[key]
+
+async def ready():
+    """Requests arriving during warm-up wait for it instead of loading indexes themselves."""
+    await asyncio.shield(warmup)
+
+@app.get("/health")
+async def health():
+    return {"status": "ok"}
+
+@app.get("/ready")
+async def readiness():
+    if not warmup.done():
+        return json_response({"ready": False}, 503)
+    if warmup.exception() is not None:
+        return json_response({"ready": False, "error": repr(warmup.exception())}, 503)
+    knowledge = engine.knowledge()
+    return {"ready": True, "items": len(knowledge), "fingerprint": knowledge.fingerprint}
+
+@app.post("/retrieve")
+async def retrieve(request: RetrieveRequest):
+    await ready()
+    tools = toolkit(request)
+    results = await asyncio.to_thread(tools.retrieval, request.query, request.fields, request.context)
+    return json_response({"results": results})
+
+@app.post("/retrieve/batch")
+async def retrieve_batch(request: RetrieveBatchRequest):
+    await ready()
+    tools = toolkit(request)
+    results = await asyncio.to_thread(tools.retrieval_batch, request.queries, request.fields, request.context)
+    return json_response({"results": results})
+
+@app.get("/stats")
+async def stats():
+    return embedding_cache_stats()
+
+if __name__ == "__main__":
+    uvicorn.run("retrieval_api:app", host="0.0.0.0", port=RETRIEVAL_API_PORT)
@@ -1,2 +1,10 @@
+from .embedding_cache import *
+from .chunking import *
+from .knowledge_store import *
+from .index_store import *
+from .lexical_index import *
+from .context_packing import *
 from .embedding_utils import *
+from .engine import *
+from .knowledge_updates import *
 from .retrieval_tools import *
\ No newline at end of file
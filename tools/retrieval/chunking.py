@@ -0,0 +1,80 @@
+from dotenv import load_dotenv
+import os
+import re
+
+load_dotenv()
+CHUNK_MODE = os.getenv("CHUNK_MODE", "paragraph")  # paragraph | sentence
+CHUNK_SIZE = int(os.getenv("CHUNK_SIZE", 1200))  # characters
+CHUNK_OVERLAP = int(os.getenv("CHUNK_OVERLAP", 200))  # characters
+
+# Extracted text (docx paragraphs, pdf lines) is often separated by single newlines only
+_PARAGRAPH = re.compile(r"\n\s*")
+_SENTENCE = re.compile(r"(?<=[.!?;:…])\s+|\n+")
+
+def _spans(text, pattern, start, end):
+    spans = []
+    for match in pattern.finditer(text, start, end):
+        if text[start:match.end()].strip():
+            spans.append((start, match.end()))
+        start = match.end()
+    if text[start:end].strip():
+        spans.append((start, end))
+    return spans
+
+def _units(text, mode, max_chars, overlap):
+    """Spans of paragraphs or sentences, paragraphs longer than `max_chars` split into sentences
+    and only sentences still too long hard-split into windows.
+    """
+    spans = _spans(text, _PARAGRAPH if mode == "paragraph" else _SENTENCE, 0, len(text))
+
+    units = []
+    step = max(1, max_chars - overlap)
+    for span in spans:
+        parts = [span]
+        if mode == "paragraph" and span[1] - span[0] > max_chars:
+            parts = _spans(text, _SENTENCE, *span)
+        for start, end in parts:
+            while end - start > max_chars:
+                units.append((start, start + max_chars))
+                start += step
+            units.append((start, end))
+    return units
+
+def _trim(text, start, end):
+    while start < end and text[start].isspace():
+        start += 1
+    while end > start and text[end - 1].isspace():
+        end -= 1
+    return start, end
+
+def chunk_text(text, mode=CHUNK_MODE, max_chars=CHUNK_SIZE, overlap=CHUNK_OVERLAP):
+    """Split `text` into overlapping windows of whole paragraphs or sentences.
+
+    Returns (start, end) character offsets, `text[start:end]` is the chunk.
+    """
+    # An overlap as wide as the window would advance hard splits by a single character
+    overlap = min(overlap, max_chars // 2)
+    units = _units(text, mode, max_chars, overlap)
+    chunks = []
+    i = 0
+    while i < len(units):
+        start = units[i][0]
+        j = i + 1
+        while j < len(units) and units[j][1] - start <= max_chars:
+            j += 1
+
+        span = _trim(text, start, units[j - 1][1])
+        if span[0] < span[1]:
+            chunks.append(span)
+        if j >= len(units):
+            break
+
+        # Start the next window on the trailing units that fit in the overlap
+        k = j
+        while k - 1 > i and units[j - 1][1] - units[k - 1][0] <= overlap:
+            k -= 1
+        # Overlap that leaves no room for the next unit would only repeat the previous chunk
+        if units[j][1] - units[k][0] > max_chars:
+            k = j
+        i = k
+    return chunks
@@ -0,0 +1,130 @@
+from dotenv import load_dotenv
+import os
+import re
+import numpy as np
+from .lexical_index import tokenize
+
+load_dotenv()
+
+# Prompt tokens one retrieval call may return
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", 1500))
+# MMR trade-off, 1 ranks by relevance only, 0 by novelty only
+CONTEXT_MMR_LAMBDA = float(os.getenv("CONTEXT_MMR_LAMBDA", 0.7))
+# Passages at least this similar to one already packed are dropped
+CONTEXT_DUPLICATE_SIMILARITY = float(os.getenv("CONTEXT_DUPLICATE_SIMILARITY", 0.95))
+# Share of relevance taken from the retrieval rank when the query embedding is known too,
+# hybrid rankings carry lexical evidence the cosine alone misses
+CONTEXT_RANK_WEIGHT = float(os.getenv("CONTEXT_RANK_WEIGHT", 0.5))
+CONTEXT_MAX_SENTENCES = int(os.getenv("CONTEXT_MAX_SENTENCES", 5))
+
+# No tokenizer for the served models here, Vietnamese runs about 3 characters per token
+CHARS_PER_TOKEN = 3.0
+# Snippets that would get less room than this are not worth a header
+MIN_SNIPPET_TOKENS = 32
+
+_SENTENCE_END = re.compile(r"(?<=[.!?;:])\s+|\n+")
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def split_sentences(text: str):
+    return [s.strip() for s in _SENTENCE_END.split(text) if s and s.strip()]
+
+def mmr_order(relevance, vectors, lam=CONTEXT_MMR_LAMBDA, duplicate=CONTEXT_DUPLICATE_SIMILARITY):
+    """Positions in maximal-marginal-relevance order, near-duplicates of a picked item left out.
+
+    `vectors` are unit rows, similarity between items is their dot product.
+    """
+    relevance = np.asarray(relevance, dtype="float32")
+    similarity = vectors @ vectors.T if len(vectors) else np.zeros((0, 0), dtype="float32")
+    candidates = list(range(len(relevance)))
+    picked = []
+    while candidates:
+        if picked:
+            redundancy = similarity[np.ix_(candidates, picked)].max(axis=1)
+        else:
+            redundancy = np.zeros(len(candidates), dtype="float32")
+        best = candidates.pop(int(np.argmax(lam * relevance[candidates] - (1 - lam) * redundancy)))
+        if picked and similarity[best, picked].max() >= duplicate:
+            continue
+        picked.append(best)
+    return picked
+
+def trim_passage(text: str, query_tokens, max_tokens: int, max_sentences=CONTEXT_MAX_SENTENCES):
+    """The sentences of `text` sharing most terms with the query, in document order, within `max_tokens`."""
+    sentences = split_sentences(text)
+    if not sentences:
+        return ""
+
+    scores = []
+    for sentence in sentences:
+        tokens = set(tokenize(sentence))
+        scores.append(len(tokens & query_tokens) / np.sqrt(len(tokens) or 1))
+    ranked = [i for i in np.argsort(-np.asarray(scores), kind="stable") if scores[i] > 0][:max_sentences]
+    if not ranked:
+        # Nothing matches lexically (a vector-only hit), the opening is the best guess
+        ranked = list(range(min(max_sentences, len(sentences))))
+
+    # Most relevant first until the budget is spent, then put back in reading order
+    kept = []
+    used = 0
+    for i in ranked:
+        cost = estimate_tokens(sentences[i]) + 1
+        if used + cost > max_tokens:
+            continue
+        kept.append(i)
+        used += cost
+    if not kept:
+        return sentences[ranked[0]][: int(max_tokens * CHARS_PER_TOKEN)].rstrip() + " …"
+
+    kept.sort()
+    parts = [sentences[kept[0]]]
+    for prev, i in zip(kept, kept[1:]):
+        parts.append(("… " if i > prev + 1 else "") + sentences[i])
+    return " ".join(parts)
+
+def pack_passages(
+    query,
+    passages,
+    knowledge,
+    query_emb=None,
+    token_budget=CONTEXT_TOKEN_BUDGET,
+    lam=CONTEXT_MMR_LAMBDA,
+    duplicate=CONTEXT_DUPLICATE_SIMILARITY,
+    rank_weight=0.0,
+):
+    """Numbered snippets with source ids from ranked (item id, text) passages, within `token_budget`.
+
+    Passages are reordered by MMR on their stored embeddings, relevance is the cosine to
+    `query_emb` blended with the retrieval rank by `rank_weight`, or the rank alone without one.
+    """
+    if not passages:
+        return []
+
+    ids = [i for i, _ in passages]
+    vectors = np.asarray(knowledge.embeddings[ids], dtype="float32").reshape(len(ids), -1)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    vectors = vectors / np.where(norms > 0, norms, 1)
+
+    relevance = 1 - np.arange(len(ids)) / len(ids)
+    if query_emb is not None and len(query_emb) == vectors.shape[1]:
+        query_vec = np.asarray(query_emb, dtype="float32")
+        cosine = vectors @ (query_vec / (np.linalg.norm(query_vec) or 1))
+        relevance = rank_weight * relevance + (1 - rank_weight) * cosine
+
+    query_tokens = set(tokenize(query))
+    snippets = []
+    used = 0
+    for position in mmr_order(relevance, vectors, lam, duplicate):
+        item, text = passages[position]
+        header = f"[{len(snippets) + 1}] (nguồn: {knowledge.sources[item]} | id: {item})"
+        room = token_budget - used - estimate_tokens(header)
+        if room < MIN_SNIPPET_TOKENS:
+            break
+        body = trim_passage(text, query_tokens, room)
+        if not body:
+            continue
+        snippet = f"{header}\n{body}"
+        snippets.append(snippet)
+        used += estimate_tokens(snippet)
+    return snippets
@@ -0,0 +1,156 @@
+from dotenv import load_dotenv
+import os
+import re
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+import numpy as np
+
+load_dotenv()
+# Empty string disables the cache
+EMBEDDING_CACHE_PATH = os.getenv("EMBEDDING_CACHE_PATH", "./data/embedding_cache.sqlite")
+# Megabytes of float32 query embeddings kept in process (16 MB ~ 4096 vectors of d=1024), 0 disables the LRU
+QUERY_EMBEDDING_CACHE_MB = float(os.getenv("QUERY_EMBEDDING_CACHE_MB", 16))
+
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_text(text: str) -> str:
+    return _WHITESPACE.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+def text_key(model: str, text: str) -> str:
+    return hashlib.sha256(f"{model}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Persistent embedding store keyed by model + hash of the normalized text."""
+
+    def __init__(self, path: str):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, dim INTEGER, vector BLOB)"
+        )
+        self._db.commit()
+
+    def get_many(self, model: str, texts):
+        """Return {position: embedding} for the texts already cached."""
+        keys = [text_key(model, t) for t in texts]
+        found = {}
+        with self._lock:
+            # Stay under sqlite's bound-parameter limit
+            for i in range(0, len(keys), 500):
+                chunk = keys[i : i + 500]
+                rows = self._db.execute(
+                    f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                    chunk,
+                ).fetchall()
+                found.update(rows)
+
+        result = {}
+        for i, key in enumerate(keys):
+            if key in found:
+                result[i] = np.frombuffer(found[key], dtype="float32")
+        self.hits += len(result)
+        self.misses += len(keys) - len(result)
+        return result
+
+    def put_many(self, model: str, texts, embeddings):
+        rows = [
+            (text_key(model, t), len(e), np.asarray(e, dtype="float32").tobytes())
+            for t, e in zip(texts, embeddings)
+            if len(e) > 0
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?)", rows)
+            self._db.commit()
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+class QueryEmbeddingLRU:
+    """Bounded in-process LRU of query embeddings keyed by model + normalized text.
+
+    Sits in front of the persistent cache, a hit costs neither a sqlite read nor an HTTP call.
+    Entries are read-only float32 arrays handed out without copying, bounded by their bytes.
+    """
+
+    def __init__(self, max_bytes: int = int(QUERY_EMBEDDING_CACHE_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get_many(self, model: str, texts):
+        """Return {position: embedding} for the texts already cached."""
+        result = {}
+        with self._lock:
+            for i, text in enumerate(texts):
+                key = (model, normalize_text(text))
+                embedding = self._entries.get(key)
+                if embedding is not None:
+                    self._entries.move_to_end(key)
+                    result[i] = embedding
+            self.hits += len(result)
+            self.misses += len(texts) - len(result)
+        return result
+
+    def put_many(self, model: str, texts, embeddings):
+        with self._lock:
+            for text, embedding in zip(texts, embeddings):
+                if len(embedding) == 0:
+                    continue
+                key = (model, normalize_text(text))
+                vector = np.array(embedding, dtype="float32")
+                vector.flags.writeable = False
+                previous = self._entries.pop(key, None)
+                if previous is not None:
+                    self._bytes -= previous.nbytes
+                self._entries[key] = vector
+                self._bytes += vector.nbytes
+            while self._bytes > self.max_bytes and self._entries:
+                _, vector = self._entries.popitem(last=False)
+                self._bytes -= vector.nbytes
+                self.evictions += 1
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / total if total else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+        }
+
+_EMBEDDING_CACHE = None
+_QUERY_CACHE = None
+
+def get_query_cache():
+    global _QUERY_CACHE
+    if _QUERY_CACHE is None and QUERY_EMBEDDING_CACHE_MB > 0:
+        _QUERY_CACHE = QueryEmbeddingLRU()
+    return _QUERY_CACHE
+
+def get_embedding_cache():
+    global _EMBEDDING_CACHE
+    if _EMBEDDING_CACHE is None and EMBEDDING_CACHE_PATH:
+        _EMBEDDING_CACHE = EmbeddingCache(EMBEDDING_CACHE_PATH)
+    return _EMBEDDING_CACHE
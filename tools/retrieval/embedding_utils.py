@@ -1,168 +1,260 @@
 from dotenv import load_dotenv
 import os
 import requests
-import faiss
 import numpy as np
-import json
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from .embedding_cache import get_embedding_cache, get_query_cache
+from .index_store import search_params
 
-_FAISS_CACHE = {}
-_KNOWLEDGE_CACHE = None
 
 load_dotenv()
 BASE_URL = os.getenv("BASE_URL")
 EMBEDDING_BEARER_TOKEN = os.getenv("EMBEDDING_BEARER_TOKEN")
 EMBEDDING_TOKEN_KEY = os.getenv("EMBEDDING_TOKEN_KEY")
 EMBEDDING_TOKEN_ID = os.getenv("EMBEDDING_TOKEN_ID")
+# model_api base url (e.g. http://localhost:2205), batches concurrent queries into one upstream call
+EMBEDDING_API_URL = os.getenv("EMBEDDING_API_URL")
+
+EMBEDDING_BATCH_SIZE = int(os.getenv("EMBEDDING_BATCH_SIZE", 256))
+EMBEDDING_BATCH_CHARS = int(os.getenv("EMBEDDING_BATCH_CHARS", 400_000))
+EMBEDDING_WORKERS = int(os.getenv("EMBEDDING_WORKERS", 4))
+EMBEDDING_RETRIES = int(os.getenv("EMBEDDING_RETRIES", 3))
+EMBEDDING_TIMEOUT = float(os.getenv("EMBEDDING_TIMEOUT", 60))
+
+EMBEDDING_MODEL = "vnptai_hackathon_embedding"
+KNOWLEDGE_STORE_PATH = os.getenv("KNOWLEDGE_STORE_PATH", "./data/knowledge")
+# Seconds between checks for a store updated by another process, 0 disables reloading
+KNOWLEDGE_RELOAD_INTERVAL = float(os.getenv("KNOWLEDGE_RELOAD_INTERVAL", 30))
+
+_SESSION = requests.Session()
+
+class EmbeddingError(Exception):
+    pass
+
+def embedding_endpoint():
+    if EMBEDDING_API_URL:
+        return f"{EMBEDDING_API_URL}/embeddings", {"Content-Type": "application/json"}
 
-def get_embedding(text):
     headers = {
         "Authorization": f"Bearer {EMBEDDING_BEARER_TOKEN}",
         "Token-id": EMBEDDING_TOKEN_ID,
         "Token-key": EMBEDDING_TOKEN_KEY,
         "Content-Type": "application/json"
     }
+    return f"{BASE_URL}/vnptai-hackathon-embedding", headers
+
+def _cached_query_embeddings(texts):
+    """{position: embedding} from the in-process LRU, then the persistent cache."""
+    lru = get_query_cache()
+    cached = lru.get_many(EMBEDDING_MODEL, texts) if lru is not None else {}
+    cache = get_embedding_cache()
+    missing = [i for i in range(len(texts)) if i not in cached]
+    if cache is not None and missing:
+        found = cache.get_many(EMBEDDING_MODEL, [texts[i] for i in missing])
+        found = {missing[j]: embedding for j, embedding in found.items()}
+        if lru is not None and found:
+            lru.put_many(EMBEDDING_MODEL, [texts[i] for i in found], list(found.values()))
+        cached.update(found)
+    return cached
+
+def _store_query_embeddings(texts, embeddings):
+    lru = get_query_cache()
+    if lru is not None:
+        lru.put_many(EMBEDDING_MODEL, texts, embeddings)
+    cache = get_embedding_cache()
+    if cache is not None:
+        cache.put_many(EMBEDDING_MODEL, texts, embeddings)
+
+def get_embedding(text):
+    cached = _cached_query_embeddings([text])
+    if cached:
+        return cached[0]
+
+    url, headers = embedding_endpoint()
 
     json_data = {
-        "model": "vnptai_hackathon_embedding",
+        "model": EMBEDDING_MODEL,
         "input": text,
         "encoding_format": "float" 
     }
-    res = requests.post(
-        f"{BASE_URL}/vnptai-hackathon-embedding",
+    res = _SESSION.post(
+        url,
         headers=headers,
-        json=json_data
+        json=json_data,
+        timeout=EMBEDDING_TIMEOUT
     )
     if res.status_code == 200:
-        return res.json()['data'][0]['embedding']
+        embedding = res.json()['data'][0]['embedding']
+        _store_query_embeddings([text], [embedding])
+        return embedding
     else:
         return []
     
 def get_embeddings(texts):
-    headers = {
-        "Authorization": f"Bearer {EMBEDDING_BEARER_TOKEN}",
-        "Token-id": EMBEDDING_TOKEN_ID,
-        "Token-key": EMBEDDING_TOKEN_KEY,
-        "Content-Type": "application/json"
-    }
+    cached = _cached_query_embeddings(texts)
+    missing = [i for i in range(len(texts)) if i not in cached]
+    if not missing:
+        return [cached[i] for i in range(len(texts))]
+
+    url, headers = embedding_endpoint()
 
     json_data = {
-        "model": "vnptai_hackathon_embedding",
-        "input": texts,
+        "model": EMBEDDING_MODEL,
+        "input": [texts[i] for i in missing],
         "encoding_format": "float" 
     }
 
-    res = requests.post(
-        f"{BASE_URL}/vnptai-hackathon-embedding",
+    res = _SESSION.post(
+        url,
         headers=headers,
-        json=json_data
+        json=json_data,
+        timeout=EMBEDDING_TIMEOUT
     )
     if res.status_code == 200:
-        return [data['embedding'] for data in res.json()['data']]
-    else:
-        return [[]]
-
-def load_knowledge():
-    global _KNOWLEDGE_CACHE
-    if _KNOWLEDGE_CACHE is not None:
-        return _KNOWLEDGE_CACHE
-
-    path = "./data/knowledge.json"
-    if not os.path.exists(path):
-        _KNOWLEDGE_CACHE = []
-        return _KNOWLEDGE_CACHE
-
-    with open(path, "r", encoding="utf-8") as f:
-        data = json.load(f)
-
-    for item in data:
-        item["embedding"] = np.array(item["embedding"], dtype="float32")
-
-    _KNOWLEDGE_CACHE = data
-    return _KNOWLEDGE_CACHE
-
-def get_ivf_index(field_key: str, data, metric="cosine"):
-    global _FAISS_CACHE
-
-    embeddings = np.array([x["embedding"] for x in data], dtype="float32")
-    cache_key = f"{field_key}_{metric}_{len(data)}"
-
-    if cache_key in _FAISS_CACHE:
-        return _FAISS_CACHE[cache_key]
-
-    if len(data) == 0:
-        return None
-
-    d = embeddings.shape[1]
-
-    # ---- Small data → Flat ----
-    if len(data) < 5000:
-        if metric == "cosine":
-            faiss.normalize_L2(embeddings)
-            index = faiss.IndexFlatIP(d)
-        else:
-            index = faiss.IndexFlatL2(d)
-
-        index.add(embeddings)
-        _FAISS_CACHE[cache_key] = index
-        return index
-
-    # ---- Large data → IVF ----
-    if metric == "cosine":
-        faiss.normalize_L2(embeddings)
-        metric_type = faiss.METRIC_INNER_PRODUCT
-        quantizer = faiss.IndexFlatIP(d)
+        embeddings = [data['embedding'] for data in res.json()['data']]
+        _store_query_embeddings(json_data["input"], embeddings)
+        cached.update(zip(missing, embeddings))
+        return [cached[i] for i in range(len(texts))]
     else:
-        metric_type = faiss.METRIC_L2
-        quantizer = faiss.IndexFlatL2(d)
-
-    nlist = int(np.sqrt(len(embeddings)))
-    index = faiss.IndexIVFFlat(quantizer, d, nlist, metric_type)
-
-    # Train with sample if huge
-    if len(embeddings) > 100000:
-        sample = embeddings[np.random.choice(len(embeddings), 100000, replace=False)]
-        index.train(sample)
-    else:
-        index.train(embeddings)
-
-    index.add(embeddings)
-    index.nprobe = min(32, nlist)
-
-    _FAISS_CACHE[cache_key] = index
-    return index
-
+        raise EmbeddingError(f"Embedding request failed with {res.status_code}: {res.text[:200]}")
+
+def embedding_cache_stats():
+    """Hit rates of the query LRU and the persistent embedding cache, None when disabled."""
+    lru = get_query_cache()
+    cache = get_embedding_cache()
+    return {
+        "query_lru": lru.stats() if lru is not None else None,
+        "persistent": cache.stats() if cache is not None else None,
+    }
 
-def vector_search(index, data, query_emb, k=5, metric="cosine"):
-    if index is None:
-        return []
+def _post_embeddings(texts):
+    url, headers = embedding_endpoint()
 
-    query = np.array([query_emb], dtype="float32")
+    json_data = {
+        "model": EMBEDDING_MODEL,
+        "input": texts,
+        "encoding_format": "float"
+    }
 
+    res = _SESSION.post(
+        url,
+        headers=headers,
+        json=json_data,
+        timeout=EMBEDDING_TIMEOUT
+    )
+    if res.status_code != 200:
+        raise EmbeddingError(f"Embedding request failed with {res.status_code}: {res.text[:200]}")
+
+    data = sorted(res.json()["data"], key=lambda x: x.get("index", 0))
+    embeddings = [x["embedding"] for x in data]
+    if len(embeddings) != len(texts) or any(len(e) == 0 for e in embeddings):
+        raise EmbeddingError(f"Expected {len(texts)} embeddings, got {len(embeddings)}")
+    return embeddings
+
+def split_batches(texts, batch_size=EMBEDDING_BATCH_SIZE, max_chars=EMBEDDING_BATCH_CHARS):
+    """Split `texts` into (start, batch) slices bounded by item count and total characters."""
+    batches = []
+    start = 0
+    chars = 0
+    for i, text in enumerate(texts):
+        if i > start and (i - start >= batch_size or chars + len(text) > max_chars):
+            batches.append((start, texts[start:i]))
+            start = i
+            chars = 0
+        chars += len(text)
+    if start < len(texts):
+        batches.append((start, texts[start:]))
+    return batches
+
+def _embed_batch(batch, retries):
+    for attempt in range(retries + 1):
+        try:
+            embeddings = _post_embeddings(batch)
+            # Store per batch so an interrupted ingest keeps its progress
+            cache = get_embedding_cache()
+            if cache is not None:
+                cache.put_many(EMBEDDING_MODEL, batch, embeddings)
+            return embeddings
+        except (EmbeddingError, requests.RequestException, KeyError, ValueError) as e:
+            if attempt == retries:
+                raise EmbeddingError(f"Batch of {len(batch)} texts failed after {retries + 1} attempts: {e}") from e
+            time.sleep(random.uniform(0, min(30, 2 ** attempt)))
+
+def get_embeddings_bulk(
+    texts,
+    batch_size=EMBEDDING_BATCH_SIZE,
+    max_chars=EMBEDDING_BATCH_CHARS,
+    workers=EMBEDDING_WORKERS,
+    retries=EMBEDDING_RETRIES,
+):
+    """Embed any number of texts, one vector per text in input order.
+
+    Batches run `workers` at a time and are retried on failure; raises EmbeddingError
+    instead of returning a short or misaligned list.
+    """
+    texts = list(texts)
+    embeddings = [None] * len(texts)
+
+    cache = get_embedding_cache()
+    if cache is not None:
+        for i, embedding in cache.get_many(EMBEDDING_MODEL, texts).items():
+            embeddings[i] = embedding
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    missing_texts = [texts[i] for i in missing]
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        futures = [
+            (start, executor.submit(_embed_batch, batch, retries))
+            for start, batch in split_batches(missing_texts, batch_size, max_chars)
+        ]
+        for start, future in futures:
+            for offset, embedding in enumerate(future.result()):
+                embeddings[missing[start + offset]] = embedding
+
+    missing = [i for i, e in enumerate(embeddings) if e is None]
+    if missing:
+        raise EmbeddingError(f"{len(missing)} texts have no embedding, first at {missing[0]}")
+    return embeddings
+
+def vector_search(index, data, query_emb, k=5, metric="cosine", bitmap=None, n_selected=None):
+    return vector_search_batch(index, data, [query_emb], k, metric, bitmap, n_selected)[0]
+
+def vector_search_batch(index, data, query_embs, k=5, metric="cosine", bitmap=None, n_selected=None):
+    """Search `index` with every query in one call, restricted to the ids set in `bitmap` when given.
+
+    `data` maps index ids to result items, None returns the ids themselves.
+    """
+    if index is None or len(query_embs) == 0:
+        return [[] for _ in query_embs]
+
+    queries = np.array(query_embs, dtype="float32")
+
+    valid = np.ones(len(queries), dtype=bool)
     if metric == "cosine":
-        if np.linalg.norm(query) == 0:
-            return []
-        faiss.normalize_L2(query)
-
-    if isinstance(index, faiss.IndexIVF):
-        index.nprobe = min(32, index.nlist)
+        valid = np.linalg.norm(queries, axis=1) > 0
+        queries[valid] /= np.linalg.norm(queries[valid], axis=1, keepdims=True)
 
-    distances, indices = index.search(query, k)
+    params = search_params(index, bitmap, n_selected)
+    distances, indices = index.search(queries, k, params=params)
 
     results = []
-    for dist, idx in zip(distances[0], indices[0]):
-        if idx == -1:
-            continue
-
-        if metric == "cosine":
-            score = float(dist)  # cosine similarity
-        else:
-            score = float(dist)
-
-        results.append({
-            "score": score,
-            "item": data[idx]
-        })
+    for row_valid, row_distances, row_indices in zip(valid, distances, indices):
+        row = []
+        for dist, idx in zip(row_distances, row_indices):
+            if idx == -1 or not row_valid:
+                continue
+
+            if metric == "cosine":
+                score = float(dist)  # cosine similarity
+            else:
+                score = float(dist)
+
+            row.append({
+                "score": score,
+                "item": data[idx] if data is not None else int(idx)
+            })
+        results.append(row)
 
     return results
-
-
@@ -0,0 +1,229 @@
+from dotenv import load_dotenv
+import os
+import json
+import time
+import threading
+import weakref
+from contextlib import contextmanager
+import faiss
+from agno.utils.log import log_warning
+from .knowledge_store import KnowledgeStore
+from .index_store import build_index, index_name, load_index
+from .lexical_index import load_lexical_index
+from .embedding_utils import KNOWLEDGE_RELOAD_INTERVAL, KNOWLEDGE_STORE_PATH, vector_search_batch
+
+load_dotenv()
+# OpenMP threads one search may use, concurrent searches share the cores instead of each taking all of them
+FAISS_SEARCH_THREADS = int(os.getenv("FAISS_SEARCH_THREADS", 1))
+# Index builds run alone and may use every core
+FAISS_BUILD_THREADS = faiss.omp_get_max_threads()
+
+@contextmanager
+def omp_threads(n):
+    """Cap the OpenMP threads of FAISS calls made by the current thread, the setting is per thread."""
+    previous = faiss.omp_get_max_threads()
+    faiss.omp_set_num_threads(n)
+    try:
+        yield
+    finally:
+        faiss.omp_set_num_threads(previous)
+
+class RetrievalEngine:
+    """Knowledge store and its vector and lexical indexes, shared by every thread of a process.
+
+    Each index is loaded or built once, concurrent callers asking for the same one wait for
+    that build. Snapshots are immutable, an update swaps in a new one under the lock. Indexes
+    stay cached while any snapshot they belong to is still referenced, e.g. by a search in flight.
+    """
+
+    def __init__(
+        self,
+        path=KNOWLEDGE_STORE_PATH,
+        reload_interval=KNOWLEDGE_RELOAD_INTERVAL,
+        search_threads=FAISS_SEARCH_THREADS,
+    ):
+        self.path = path
+        self.reload_interval = reload_interval
+        self.search_threads = search_threads
+        self._knowledge = None
+        self._mtime = None
+        self._checked = 0.0
+        self._indexes = {}
+        self._lexical = {}
+        self._lock = threading.RLock()
+        self._build_locks = {}
+        # Live snapshot objects per snapshot key, a delete keeps the key of the snapshot before it
+        self._tracked = weakref.WeakSet()
+        self._refs = {}
+
+    def _store_mtime(self):
+        try:
+            return os.stat(os.path.join(self.path, "meta.json")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def knowledge(self):
+        """Current snapshot, reopened when another process rewrote the store."""
+        knowledge = self._knowledge
+        if knowledge is not None and (
+            self.reload_interval <= 0 or time.monotonic() - self._checked < self.reload_interval
+        ):
+            return knowledge
+
+        with self._lock:
+            if self._knowledge is None:
+                return self.reload()
+            if time.monotonic() - self._checked < self.reload_interval:
+                return self._knowledge
+            self._checked = time.monotonic()
+            if self._store_mtime() == self._mtime:
+                return self._knowledge
+            try:
+                return self.reload()
+            except ValueError as e:
+                # Caught mid-update, the next check picks up the finished snapshot
+                log_warning(f"Keeping the current knowledge store: {e}")
+                return self._knowledge
+
+    def reload(self):
+        """(Re)open the knowledge store from disk, e.g. after another process updated it."""
+        with self._lock:
+            mtime = self._store_mtime()
+            if mtime is not None:
+                knowledge = KnowledgeStore.open(self.path)
+            else:
+                # Legacy json knowledge base, parsed fully into memory
+                path = "./data/knowledge.json"
+                if not os.path.exists(path):
+                    knowledge = KnowledgeStore.from_items([])
+                else:
+                    with open(path, "r", encoding="utf-8") as f:
+                        knowledge = KnowledgeStore.from_items(json.load(f))
+
+            self._set(knowledge, mtime)
+            return knowledge
+
+    def set_snapshot(self, knowledge, indexes=None, lexical=None):
+        """Serve an updated snapshot with already built indexes, vector ones by metric.
+
+        Indexes of earlier snapshots stay cached as long as searches in flight hold them.
+        """
+        with self._lock:
+            self._set(knowledge, self._store_mtime())
+            for metric, index in (indexes or {}).items():
+                self._indexes[(metric, self._snapshot_key(knowledge))] = index
+            if lexical is not None:
+                self._lexical[self._snapshot_key(knowledge)] = lexical
+
+    def _set(self, knowledge, mtime):
+        self._track(knowledge)
+        self._knowledge = knowledge
+        self._mtime = mtime
+        self._checked = time.monotonic()
+
+    def _track(self, knowledge):
+        """Count `knowledge` as a user of its snapshot key until it is garbage collected."""
+        with self._lock:
+            if knowledge in self._tracked:
+                return
+            key = self._snapshot_key(knowledge)
+            self._tracked.add(knowledge)
+            self._refs[key] = self._refs.get(key, 0) + 1
+            weakref.finalize(knowledge, self._release, key)
+
+    def _release(self, key):
+        with self._lock:
+            self._refs[key] -= 1
+            if self._refs[key] > 0:
+                return
+            del self._refs[key]
+            if self._knowledge is None or key != self._snapshot_key(self._knowledge):
+                self._evict(key)
+
+    def _evict(self, key):
+        self._indexes = {k: v for k, v in self._indexes.items() if k[1] != key}
+        self._lexical.pop(key, None)
+        self._build_locks = {k: v for k, v in self._build_locks.items() if k[-1] != key}
+
+    @staticmethod
+    def _snapshot_key(knowledge):
+        return f"{knowledge.fingerprint}_{len(knowledge)}"
+
+    def _cached(self, cache, key, build_key, build):
+        value = cache.get(key)
+        if value is not None:
+            return value
+        with self._lock:
+            lock = self._build_locks.setdefault(build_key, threading.Lock())
+        with lock:
+            value = cache.get(key)
+            if value is None:
+                with omp_threads(FAISS_BUILD_THREADS):
+                    value = build()
+                with self._lock:
+                    # Evicted meanwhile: the caller gets it, the cache does not keep it
+                    if build_key[-1] in self._refs:
+                        cache[key] = value
+            return value
+
+    def index(self, knowledge, metric="cosine"):
+        """One vector index over the whole corpus, field filtering happens at search time."""
+        if len(knowledge) == 0:
+            return None
+        self._track(knowledge)
+        key = (metric, self._snapshot_key(knowledge))
+
+        def build():
+            # Prebuilt at ingestion, otherwise built in-process
+            index = load_index(knowledge, index_name("all", metric))
+            if index is None:
+                index, _ = build_index(knowledge.embeddings, metric)
+            return index
+
+        return self._cached(self._indexes, key, ("vector",) + key, build)
+
+    def lexical(self, knowledge):
+        self._track(knowledge)
+        key = self._snapshot_key(knowledge)
+        return self._cached(self._lexical, key, ("lexical", key), lambda: load_lexical_index(knowledge))
+
+    def vector_search(self, knowledge, query_embs, k=5, metric="cosine", bitmap=None, n_selected=None):
+        """Top `k` ids per query, search parameters are per call and the shared index is never touched."""
+        index = self.index(knowledge, metric)
+        with omp_threads(self.search_threads):
+            return vector_search_batch(index, None, query_embs, k, metric, bitmap, n_selected)
+
+    def preload(self, metric="cosine", lexical=True):
+        """Load the knowledge store and its indexes so the first query does not pay for it."""
+        knowledge = self.knowledge()
+        self.index(knowledge, metric)
+        if lexical:
+            self.lexical(knowledge)
+        return knowledge
+
+_ENGINE = None
+_ENGINE_LOCK = threading.Lock()
+
+def get_engine():
+    """The process-wide engine, created on first use."""
+    global _ENGINE
+    if _ENGINE is None:
+        with _ENGINE_LOCK:
+            if _ENGINE is None:
+                _ENGINE = RetrievalEngine()
+    return _ENGINE
+
+def load_knowledge():
+    return get_engine().knowledge()
+
+def reload_knowledge():
+    return get_engine().reload()
+
+def get_ivf_index(knowledge, metric="cosine"):
+    return get_engine().index(knowledge, metric)
+
+def get_lexical_index(knowledge):
+    return get_engine().lexical(knowledge)
+
+def preload_indexes(metric="cosine"):
+    get_engine().preload(metric, lexical=False)
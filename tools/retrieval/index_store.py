@@ -0,0 +1,288 @@
+import os
+import json
+import weakref
+import faiss
+import numpy as np
+from agno.utils.log import log_debug, log_warning
+from dotenv import load_dotenv
+
+load_dotenv()
+
+INDEX_DIR = "indexes"
+
+INDEX_TYPE = os.getenv("INDEX_TYPE", "auto")  # auto | flat | hnsw | ivf_flat | ivf_sq8 | ivf_pq | pca_ivf_pq
+INDEX_MEMORY_BUDGET = int(float(os.getenv("INDEX_MEMORY_BUDGET_MB", 4096)) * 1024 * 1024)
+INDEX_TARGET_RECALL = float(os.getenv("INDEX_TARGET_RECALL", 0.95))
+INDEX_PCA_DIM = int(os.getenv("INDEX_PCA_DIM", 0))  # 0 = d / 2 when PCA is used
+
+# Rough recall@10 of each family at its default search parameters, only used to rank them
+EXPECTED_RECALL = {
+    "flat": 1.0,
+    "hnsw": 0.98,
+    "ivf_flat": 0.95,
+    "ivf_sq8": 0.93,
+    "ivf_pq": 0.80,
+    "pca_ivf_pq": 0.70,
+}
+
+# Indexes loaded memory mapped read-only, faiss objects take no extra attributes to flag them
+_READ_ONLY = weakref.WeakSet()
+
+HNSW_M = 32
+HNSW_EF_SEARCH = 64
+# Cap on the efSearch a selective filter scales up to, beyond it a flat scan of the selection is cheaper
+HNSW_MAX_EF_SEARCH = 1024
+
+def _pq_m(d, max_m):
+    """Largest number of PQ sub-quantizers dividing `d`, at most `max_m`."""
+    for m in range(min(max_m, d), 0, -1):
+        if d % m == 0:
+            return m
+    return 1
+
+def estimate_bytes(params, n, d):
+    """Approximate resident size of an index, vectors plus the bigger fixed structures."""
+    index_type = params["type"]
+    dim = params.get("pca_dim") or d
+    per_vector = {
+        "flat": 4 * d,
+        "hnsw": 4 * d + 2 * HNSW_M * 4,
+        "ivf_flat": 4 * d + 8,
+        "ivf_sq8": d + 8,
+        "ivf_pq": params.get("pq_m", 0) + 8,
+        "pca_ivf_pq": params.get("pq_m", 0) + 8,
+    }[index_type]
+    fixed = params.get("nlist", 0) * dim * 4
+    if params.get("pca_dim"):
+        fixed += d * params["pca_dim"] * 4
+    return n * per_vector + fixed
+
+def choose_index_params(
+    n,
+    d,
+    index_type=INDEX_TYPE,
+    memory_budget=INDEX_MEMORY_BUDGET,
+    target_recall=INDEX_TARGET_RECALL,
+    pca_dim=INDEX_PCA_DIM,
+):
+    """Pick an index family and its parameters for `n` vectors of dimension `d`.
+
+    With `index_type="auto"` the smallest family expected to reach `target_recall` within
+    `memory_budget` wins; if none does, the most accurate one that fits, else the smallest.
+    """
+    nlist = max(1, min(int(np.sqrt(n)), n // 39 or 1))
+
+    def params_for(family):
+        params = {"type": family}
+        if family.startswith("ivf") or family == "pca_ivf_pq":
+            params["nlist"] = nlist
+            params["nprobe"] = min(32, nlist)
+        if family == "hnsw":
+            params["hnsw_m"] = HNSW_M
+            params["ef_search"] = HNSW_EF_SEARCH
+        if family == "pca_ivf_pq":
+            params["pca_dim"] = pca_dim or max(8, d // 2)
+        if family in ("ivf_pq", "pca_ivf_pq"):
+            params["pq_m"] = _pq_m(params.get("pca_dim") or d, 64)
+        params["expected_recall"] = EXPECTED_RECALL[family]
+        params["estimated_bytes"] = int(estimate_bytes(params, n, d))
+        return params
+
+    if index_type != "auto":
+        return params_for(index_type)
+
+    # ---- Small data → Flat, exact search is cheap ----
+    if n < 5000 and estimate_bytes({"type": "flat"}, n, d) <= memory_budget:
+        return params_for("flat")
+
+    candidates = [params_for(family) for family in EXPECTED_RECALL if family != "flat"]
+    fitting = [p for p in candidates if p["estimated_bytes"] <= memory_budget]
+    good = [p for p in fitting if p["expected_recall"] >= target_recall]
+    if good:
+        return min(good, key=lambda p: p["estimated_bytes"])
+    if fitting:
+        return max(fitting, key=lambda p: p["expected_recall"])
+    return min(candidates, key=lambda p: p["estimated_bytes"])
+
+def _factory_string(params):
+    family = params["type"]
+    if family == "flat":
+        return "Flat"
+    if family == "hnsw":
+        return f"HNSW{params['hnsw_m']},Flat"
+    ivf = f"IVF{params['nlist']}"
+    if family == "ivf_flat":
+        return f"{ivf},Flat"
+    if family == "ivf_sq8":
+        return f"{ivf},SQ8"
+    if family == "ivf_pq":
+        return f"{ivf},PQ{params['pq_m']}x8"
+    if family == "pca_ivf_pq":
+        return f"PCA{params['pca_dim']},{ivf},PQ{params['pq_m']}x8"
+    raise ValueError(f"Unknown index type {family}")
+
+def build_index(embeddings, metric="cosine", params=None):
+    """Build an index, returns it with the parameters it was built with."""
+    embeddings = np.array(embeddings, dtype="float32")
+    n, d = embeddings.shape
+    params = dict(params) if params is not None else choose_index_params(n, d)
+    # Vectors appended later are assigned to centroids trained without them
+    params["trained_on"] = n
+
+    if metric == "cosine":
+        faiss.normalize_L2(embeddings)
+        metric_type = faiss.METRIC_INNER_PRODUCT
+    else:
+        metric_type = faiss.METRIC_L2
+
+    index = faiss.index_factory(d, _factory_string(params), metric_type)
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf = faiss.downcast_index(ivf)
+    if isinstance(ivf, faiss.IndexIVFPQ):
+        # Only used by polysemous search, and slow to train
+        ivf.do_polysemous_training = False
+
+    if not index.is_trained:
+        # Train with sample if huge
+        if n > 100000:
+            index.train(embeddings[np.random.choice(n, 100000, replace=False)])
+        else:
+            index.train(embeddings)
+
+    index.add(embeddings)
+
+    if ivf is not None:
+        ivf.nprobe = params["nprobe"]
+    if params["type"] == "hnsw":
+        faiss.downcast_index(index).hnsw.efSearch = params["ef_search"]
+
+    return index, params
+
+def extend_index(index, embeddings, metric="cosine", copy=None):
+    """Add `embeddings` after the current vectors of `index`, nothing is retrained.
+
+    Added in place unless the index is memory mapped read-only or `copy` is set, e.g. for an
+    index other threads are searching. Returns the extended index.
+    """
+    if copy is None:
+        copy = index in _READ_ONLY
+    if copy:
+        index = faiss.deserialize_index(faiss.serialize_index(index))
+    embeddings = np.array(embeddings, dtype="float32")
+    if len(embeddings):
+        if metric == "cosine":
+            faiss.normalize_L2(embeddings)
+        index.add(embeddings)
+    return index
+
+def search_params(index, bitmap=None, n_selected=None):
+    """Per-call search parameters, the shared index itself is never modified."""
+    selector = None
+    if bitmap is not None:
+        selector = faiss.IDSelectorBitmap(len(bitmap), faiss.swig_ptr(bitmap))
+
+    inner = index
+    if isinstance(index, faiss.IndexPreTransform):
+        inner = faiss.downcast_index(index.index)
+
+    ivf = faiss.try_extract_index_ivf(inner)
+    if ivf is not None:
+        nprobe = ivf.nprobe
+        # A selective filter leaves few candidates per list, probe more lists to still fill k
+        if bitmap is not None and n_selected:
+            nprobe = min(ivf.nlist, int(np.ceil(nprobe * index.ntotal / n_selected)))
+        params = faiss.SearchParametersIVF(nprobe=nprobe)
+    elif isinstance(inner, faiss.IndexHNSW):
+        ef_search = inner.hnsw.efSearch
+        # Filtered-out nodes still fill the candidate list, widen it by the same ratio
+        if bitmap is not None and n_selected:
+            ef_search = max(ef_search, min(HNSW_MAX_EF_SEARCH, int(np.ceil(ef_search * index.ntotal / n_selected))))
+        params = faiss.SearchParametersHNSW(efSearch=ef_search)
+    else:
+        params = faiss.SearchParameters()
+
+    if selector is not None:
+        params.sel = selector
+
+    if inner is not index:
+        params = faiss.SearchParametersPreTransform(index_params=params)
+    # SWIG does not keep the selector or bitmap alive through params
+    params._keepalive = (selector, bitmap)
+    return params
+
+def _index_paths(store_path, name):
+    base = os.path.join(store_path, INDEX_DIR, name)
+    return f"{base}.faiss", f"{base}.json"
+
+def save_index(knowledge, name, index, metric, field_key, params=None):
+    index_path, manifest_path = _index_paths(knowledge.path, name)
+    os.makedirs(os.path.dirname(index_path), exist_ok=True)
+
+    faiss.write_index(index, index_path + ".tmp")
+    os.replace(index_path + ".tmp", index_path)
+    with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+        json.dump({
+            "knowledge_fingerprint": knowledge.fingerprint,
+            "count": int(index.ntotal),
+            "metric": metric,
+            "field_key": field_key,
+            "index_type": type(index).__name__,
+            "index_params": params,
+        }, f, ensure_ascii=False, indent=4)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+def load_manifest(knowledge, name):
+    """Manifest of the prebuilt index `name`, None if there is none."""
+    if knowledge.path is None:
+        return None
+    _, manifest_path = _index_paths(knowledge.path, name)
+    if not os.path.exists(manifest_path):
+        return None
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+def load_index(knowledge, name, mmap=True):
+    """Load a prebuilt index for `knowledge`, or None if it is missing or stale.
+
+    Memory mapped indexes are read-only, `mmap=False` reads a private writable copy.
+    """
+    if knowledge.path is None or knowledge.fingerprint is None:
+        return None
+
+    index_path, _ = _index_paths(knowledge.path, name)
+    manifest = load_manifest(knowledge, name)
+    if not os.path.exists(index_path) or manifest is None:
+        return None
+
+    if manifest.get("knowledge_fingerprint") != knowledge.fingerprint:
+        log_warning(f"Prebuilt index {name} belongs to another knowledge snapshot, ignoring it")
+        return None
+
+    index = None
+    if mmap:
+        try:
+            index = faiss.read_index(index_path, faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY)
+            _READ_ONLY.add(index)
+        except RuntimeError:
+            pass
+    if index is None:
+        index = faiss.read_index(index_path)
+
+    if index.ntotal != manifest.get("count"):
+        log_warning(f"Prebuilt index {name} has {index.ntotal} vectors, manifest says {manifest.get('count')}")
+        return None
+
+    log_debug(f"Loaded prebuilt index {name} ({type(index).__name__}, {index.ntotal} vectors)")
+    return index
+
+def index_name(field_key, metric):
+    return f"{field_key}_{metric}"
+
+def build_knowledge_indexes(knowledge, metric="cosine"):
+    """Build and save the corpus-wide index, field filters are applied at search time."""
+    if len(knowledge) == 0:
+        return
+    index, params = build_index(knowledge.embeddings, metric)
+    save_index(knowledge, index_name("all", metric), index, metric, "all", params)
+    log_debug(f"Built {params['type']} index over {len(knowledge)} vectors: {params}")
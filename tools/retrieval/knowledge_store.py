@@ -0,0 +1,498 @@
+import os
+import json
+import io
+import hashlib
+import numpy as np
+
+KNOWLEDGE_STORE_VERSION = 1
+# Distinct fields a store can tag items with, one bit each in field_masks.npy
+MAX_FIELDS = 64
+
+def _append_npy(path, rows, count):
+    """Write `rows` after the first `count` rows of an .npy file and grow its header in place.
+
+    Rows past `count` (an interrupted append) are overwritten. Returns False, leaving the file
+    untouched, when dtype or row shape differ or the header has no room for the new shape.
+    """
+    if not os.path.exists(path):
+        return False
+    with open(path, "r+b") as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+            write_header = np.lib.format.write_array_header_1_0
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+            write_header = np.lib.format.write_array_header_2_0
+        data_offset = f.tell()
+        if fortran_order or dtype != rows.dtype or tuple(shape[1:]) != rows.shape[1:] or shape[0] < count:
+            return False
+
+        # numpy pads headers so the first dimension can grow without moving the data
+        header = io.BytesIO()
+        write_header(header, {
+            "descr": np.lib.format.dtype_to_descr(dtype),
+            "fortran_order": False,
+            "shape": (count + len(rows),) + tuple(shape[1:]),
+        })
+        if len(header.getvalue()) != data_offset:
+            return False
+
+        # Data first, readers trust the header shape
+        f.seek(data_offset + count * dtype.itemsize * int(np.prod(shape[1:], dtype="int64")))
+        f.truncate()
+        f.write(np.ascontiguousarray(rows).tobytes())
+        f.flush()
+        f.seek(0)
+        f.write(header.getvalue())
+    return True
+
+def _encode_fields(fields, names):
+    """Bitmask per item of its fields, bit j standing for `names[j]`; new names are appended."""
+    lookup = {name: j for j, name in enumerate(names)}
+    masks = np.zeros(len(fields), dtype="uint64")
+    for i, item_fields in enumerate(fields):
+        mask = 0
+        for field in item_fields:
+            if field not in lookup:
+                if len(names) == MAX_FIELDS:
+                    raise ValueError(f"Knowledge store supports at most {MAX_FIELDS} fields")
+                lookup[field] = len(names)
+                names.append(field)
+            mask |= 1 << lookup[field]
+        masks[i] = mask
+    return masks
+
+def _encode_sources(sources, names):
+    """Index of each item's source in `names`; new names are appended."""
+    lookup = {name: j for j, name in enumerate(names)}
+    ids = np.zeros(len(sources), dtype="int64")
+    for i, source in enumerate(sources):
+        if source not in lookup:
+            lookup[source] = len(names)
+            names.append(source)
+        ids[i] = lookup[source]
+    return ids
+
+class _Fields:
+    """Field names of each item, decoded from the bitmasks on access."""
+
+    def __init__(self, masks, names):
+        self.masks = masks
+        self.names = names
+
+    def __len__(self):
+        return len(self.masks)
+
+    def __getitem__(self, i):
+        mask = int(self.masks[i])
+        return [name for j, name in enumerate(self.names) if mask >> j & 1]
+
+class _Sources:
+    """Source path of each item, looked up from its source id on access."""
+
+    def __init__(self, ids, names):
+        self.ids = ids
+        self.names = names
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, i):
+        return self.names[self.ids[i]]
+
+class KnowledgeStore:
+    """Knowledge base laid out for memory mapping.
+
+    A store directory holds:
+        embeddings.npy   float32 (N, d) matrix, opened with mmap
+        texts.bin        utf-8 texts back to back, opened with mmap
+        offsets.npy      int64 (N + 1,) byte offsets into texts.bin
+        spans.npy        int64 (N, 3) document id, start and end character offset of each chunk
+        field_masks.npy  uint64 (N,) bit j set when the item is tagged with field j
+        source_ids.npy   int64 (N,) index of the item's source path
+        meta.json        field names, source paths and deleted item ids, written last
+    Opening only maps the files, pages are shared between processes and read on demand.
+    The source path is the stable id of a document, `append`, `delete` and `compact` write
+    a new snapshot and return it opened, deleted items stay in place until compaction.
+    With `commit=False` the data files are written but meta.json is not: the snapshot can be
+    indexed under its new fingerprint first, readers only switch to it on `commit()`.
+    `append` grows the data files in place, rows past the count in meta.json are not part
+    of the snapshot yet and readers ignore them.
+    """
+
+    def __init__(
+        self, embeddings, offsets, texts, field_masks, field_names, source_ids, source_names,
+        spans=None, path=None, fingerprint=None, deleted=None,
+    ):
+        self.embeddings = embeddings
+        self.offsets = offsets
+        self._texts = texts
+        self.field_masks = field_masks
+        self.field_names = field_names
+        self.source_ids = source_ids
+        self.source_names = source_names
+        self.fields = _Fields(field_masks, field_names)
+        self.sources = _Sources(source_ids, source_names)
+        # Without chunk spans every item is its own document, offsets are unknown
+        if spans is None:
+            spans = np.zeros((len(field_masks), 3), dtype="int64")
+            spans[:, 0] = np.arange(len(field_masks))
+        self.spans = spans
+        self.path = path
+        # Identifies the snapshot, prebuilt indexes record it to detect staleness
+        self.fingerprint = fingerprint
+        # Packed little-endian bitsets per field combination asked for, the layout faiss.IDSelectorBitmap reads
+        self._bitmaps = {}
+        self._source_lookup = None
+        # meta.json of a snapshot staged with commit=False, written by `commit`
+        self._meta = None
+        # Tombstones, searches skip them through `live_filter` and `field_filter`
+        self.deleted = np.array(sorted(deleted or []), dtype="int64")
+        self._live = None
+        if len(self.deleted):
+            mask = np.ones(len(self), dtype=bool)
+            mask[self.deleted] = False
+            self._live = np.packbits(mask, bitorder="little")
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return cls._open(path, meta)
+
+    @classmethod
+    def _open(cls, path, meta):
+        version = meta.get("version")
+        if version != KNOWLEDGE_STORE_VERSION:
+            raise ValueError(f"Unsupported knowledge store version {version} in {path}")
+
+        # Files may hold rows of an append in progress, the snapshot is the first `count` rows
+        count = meta["count"]
+        embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode="r")
+        spans_path = os.path.join(path, "spans.npy")
+        spans = np.load(spans_path, mmap_mode="r") if os.path.exists(spans_path) else None
+        field_names, source_names = meta["field_names"], meta["source_names"]
+        field_masks = np.load(os.path.join(path, "field_masks.npy"), mmap_mode="r")
+        source_ids = np.load(os.path.join(path, "source_ids.npy"), mmap_mode="r")
+        if min(len(offsets) - 1, len(embeddings), len(field_masks), len(source_ids)) < count or (
+            spans is not None and len(spans) < count
+        ):
+            raise ValueError(f"Knowledge store in {path} is being rewritten, meta.json does not match its data")
+        texts_path = os.path.join(path, "texts.bin")
+        # np.memmap cannot map an empty file
+        if os.path.getsize(texts_path) > 0:
+            texts = np.memmap(texts_path, dtype="uint8", mode="r")
+        else:
+            texts = np.zeros(0, dtype="uint8")
+        return cls(
+            embeddings[:count], offsets[:count + 1], texts,
+            field_masks[:count], field_names, source_ids[:count], source_names,
+            spans=spans[:count] if spans is not None else None,
+            path=path, fingerprint=meta.get("fingerprint"), deleted=meta.get("deleted"),
+        )
+
+    @classmethod
+    def from_items(cls, items):
+        """Build an in-memory store from legacy knowledge.json items."""
+        encoded = [x["text"].encode("utf-8") for x in items]
+        offsets = np.zeros(len(items) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        texts = np.frombuffer(b"".join(encoded), dtype="uint8")
+        if items:
+            embeddings = np.array([x["embedding"] for x in items], dtype="float32")
+        else:
+            embeddings = np.zeros((0, 0), dtype="float32")
+        field_names, source_names = [], []
+        return cls(
+            embeddings, offsets, texts,
+            _encode_fields([x["fields"] for x in items], field_names), field_names,
+            _encode_sources([x.get("source") for x in items], source_names), source_names,
+        )
+
+    @staticmethod
+    def write(path, texts, fields, sources, embeddings, spans=None):
+        """Write a store, `spans` holds (document id, start, end) per chunk, None when items are whole documents."""
+        if spans is None:
+            spans = [(i, 0, len(t)) for i, t in enumerate(texts)]
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = np.zeros(len(texts) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        field_names, source_names = [], []
+        meta = KnowledgeStore._write(
+            path, b"".join(encoded), offsets,
+            _encode_fields(fields, field_names), field_names,
+            _encode_sources(sources, source_names), source_names,
+            embeddings, spans,
+        )
+        KnowledgeStore._write_meta(path, meta)
+
+    @staticmethod
+    def _write(path, blob, offsets, field_masks, field_names, source_ids, source_names, embeddings, spans, deleted=()):
+        """Write the data files, returns the meta.json that commits them."""
+        os.makedirs(path, exist_ok=True)
+        embeddings = np.asarray(embeddings, dtype="float32")
+        n = len(offsets) - 1
+        if n != len(embeddings) or n != len(field_masks) or n != len(source_ids):
+            raise ValueError(
+                f"Misaligned knowledge: {n} texts, {len(field_masks)} fields, "
+                f"{len(source_ids)} sources, {len(embeddings)} embeddings"
+            )
+        offsets = np.asarray(offsets, dtype="int64")
+        spans = np.asarray(spans, dtype="int64").reshape(n, 3)
+        field_masks = np.asarray(field_masks, dtype="uint64")
+        source_ids = np.asarray(source_ids, dtype="int64")
+
+        digest = hashlib.sha256()
+        digest.update(embeddings.tobytes())
+        digest.update(offsets.tobytes())
+        digest.update(spans.tobytes())
+        digest.update(blob)
+        digest.update(field_masks.tobytes())
+        digest.update(json.dumps(list(field_names), ensure_ascii=False).encode("utf-8"))
+
+        # Write under temporary names and rename, meta.json is left to the caller so readers never see a partial store
+        def tmp(name):
+            return os.path.join(path, f".{name}.tmp")
+
+        arrays = {
+            "embeddings.npy": embeddings,
+            "offsets.npy": offsets,
+            "spans.npy": spans,
+            "field_masks.npy": field_masks,
+            "source_ids.npy": source_ids,
+        }
+        for name, array in arrays.items():
+            with open(tmp(name), "wb") as f:
+                np.save(f, array)
+        with open(tmp("texts.bin"), "wb") as f:
+            f.write(blob)
+
+        for name in list(arrays) + ["texts.bin"]:
+            os.replace(tmp(name), os.path.join(path, name))
+        return {
+            "version": KNOWLEDGE_STORE_VERSION,
+            "count": n,
+            "dim": int(embeddings.shape[1]) if embeddings.ndim == 2 else 0,
+            "fingerprint": digest.hexdigest(),
+            "field_names": list(field_names),
+            "source_names": list(source_names),
+            "deleted": [int(i) for i in deleted],
+        }
+
+    @staticmethod
+    def _write_meta(path, meta):
+        tmp = os.path.join(path, ".meta.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.replace(tmp, os.path.join(path, "meta.json"))
+
+    def _snapshot(self, meta, commit):
+        if commit:
+            self._write_meta(self.path, meta)
+            return KnowledgeStore.open(self.path)
+        snapshot = KnowledgeStore._open(self.path, meta)
+        snapshot._meta = meta
+        return snapshot
+
+    def commit(self):
+        """Write the meta.json of a snapshot staged with commit=False, readers switch to it from here on."""
+        if self._meta is not None:
+            self._write_meta(self.path, self._meta)
+            self._meta = None
+        return self
+
+    def _require_path(self):
+        if self.path is None:
+            raise ValueError("In-memory knowledge store cannot be updated, write it to a directory first")
+
+    def append(self, texts, fields, sources, embeddings, spans, delete=(), commit=True):
+        """Append chunks after the existing items, optionally deleting items in the same snapshot.
+
+        Existing item ids are unchanged, so indexes over them can be extended instead of rebuilt.
+        Only the new rows are written, meta.json last, the fingerprint chains the previous one.
+        """
+        self._require_path()
+        embeddings = np.asarray(embeddings, dtype="float32")
+        encoded = [t.encode("utf-8") for t in texts]
+        offsets = self.offsets[-1] + np.cumsum([len(b) for b in encoded], dtype="int64")
+        spans = np.asarray(spans, dtype="int64").reshape(-1, 3)
+        field_names = list(self.field_names)
+        source_names = list(self.source_names)
+        field_masks = _encode_fields(fields, field_names)
+        source_ids = _encode_sources(sources, source_names)
+        deleted = sorted(set(self.deleted.tolist()) | set(delete))
+
+        n = len(self)
+        blob = b"".join(encoded)
+        grown = n > 0 and self.embeddings.shape[1:] == embeddings.shape[1:] and all(
+            _append_npy(os.path.join(self.path, name), rows, count)
+            for name, rows, count in [
+                ("embeddings.npy", embeddings, n),
+                ("offsets.npy", offsets, n + 1),
+                ("spans.npy", spans, n),
+                ("field_masks.npy", field_masks, n),
+                ("source_ids.npy", source_ids, n),
+            ]
+        )
+        if not grown:
+            # Empty store, new dimension or a legacy layout, fall back to a full rewrite
+            meta = self._write(
+                self.path,
+                bytes(self._texts[: self.offsets[-1]]) + blob,
+                np.concatenate([self.offsets, offsets]),
+                np.concatenate([self.field_masks, field_masks]),
+                field_names,
+                np.concatenate([self.source_ids, source_ids]),
+                source_names,
+                np.concatenate([self.embeddings, embeddings]) if n else embeddings,
+                np.concatenate([np.asarray(self.spans, dtype="int64").reshape(-1, 3), spans]),
+                deleted=deleted,
+            )
+            return self._snapshot(meta, commit)
+
+        with open(os.path.join(self.path, "texts.bin"), "r+b") as f:
+            f.seek(int(self.offsets[-1]))
+            f.truncate()
+            f.write(blob)
+
+        digest = hashlib.sha256()
+        digest.update((self.fingerprint or "").encode("utf-8"))
+        digest.update(embeddings.tobytes())
+        digest.update(offsets.tobytes())
+        digest.update(spans.tobytes())
+        digest.update(blob)
+        digest.update(field_masks.tobytes())
+        digest.update(json.dumps(field_names, ensure_ascii=False).encode("utf-8"))
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        meta.update({
+            "count": n + len(texts),
+            "fingerprint": digest.hexdigest(),
+            "field_names": field_names,
+            "source_names": source_names,
+            "deleted": [int(i) for i in deleted],
+        })
+        return self._snapshot(meta, commit)
+
+    def delete(self, ids):
+        """Mark items deleted, only meta.json is rewritten and the fingerprint is kept."""
+        self._require_path()
+        with open(os.path.join(self.path, "meta.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        meta["deleted"] = sorted(set(self.deleted.tolist()) | {int(i) for i in ids})
+        self._write_meta(self.path, meta)
+        return KnowledgeStore.open(self.path)
+
+    def compact(self, commit=True):
+        """Drop deleted items for good, the remaining items are renumbered."""
+        self._require_path()
+        keep = np.setdiff1d(np.arange(len(self)), self.deleted)
+        encoded = [bytes(self._texts[self.offsets[i] : self.offsets[i + 1]]) for i in keep]
+        offsets = np.zeros(len(keep) + 1, dtype="int64")
+        offsets[1:] = np.cumsum([len(b) for b in encoded])
+        # Sources of fully deleted documents are dropped with them
+        used, source_ids = np.unique(np.asarray(self.source_ids[keep]), return_inverse=True)
+        meta = self._write(
+            self.path,
+            b"".join(encoded),
+            offsets,
+            np.asarray(self.field_masks[keep]),
+            self.field_names,
+            source_ids,
+            [self.source_names[i] for i in used],
+            np.asarray(self.embeddings[keep], dtype="float32").reshape(len(keep), -1),
+            np.asarray(self.spans, dtype="int64").reshape(-1, 3)[keep],
+        )
+        return self._snapshot(meta, commit)
+
+    def ids_for_sources(self, sources):
+        """Live item ids of the documents with the given source paths."""
+        if self._source_lookup is None:
+            self._source_lookup = {name: j for j, name in enumerate(self.source_names)}
+        wanted = [self._source_lookup[s] for s in set(sources) if s in self._source_lookup]
+        if not wanted:
+            return []
+        ids = np.flatnonzero(np.isin(self.source_ids, wanted))
+        return [int(i) for i in np.setdiff1d(ids, self.deleted)]
+
+    def next_document_id(self):
+        return int(np.max(self.spans[:, 0])) + 1 if len(self) else 0
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def text(self, i):
+        return bytes(self._texts[self.offsets[i] : self.offsets[i + 1]]).decode("utf-8")
+
+    def context(self, i, window=1):
+        """Chunk `i` joined with up to `window` neighbouring chunks of the same document on each side.
+
+        Returns the merged text and the ids of the chunks it covers.
+        """
+        doc_id = self.spans[i][0]
+        lo = i
+        while lo > i - window and lo > 0 and self.spans[lo - 1][0] == doc_id:
+            lo -= 1
+        hi = i
+        while hi < i + window and hi + 1 < len(self) and self.spans[hi + 1][0] == doc_id:
+            hi += 1
+
+        text = self.text(lo)
+        end = self.spans[lo][2]
+        for j in range(lo + 1, hi + 1):
+            _, start, chunk_end = self.spans[j]
+            chunk = self.text(j)
+            # Consecutive chunks overlap, only append what lies past the current end
+            if start < end:
+                chunk = chunk[end - start:]
+            elif start > end:
+                chunk = "\n" + chunk
+            text += chunk
+            end = max(end, chunk_end)
+        return text, list(range(lo, hi + 1))
+
+    def _field_bits(self, fields):
+        bits = 0
+        for field in set(fields):
+            if field in self.field_names:
+                bits |= 1 << self.field_names.index(field)
+        return np.uint64(bits)
+
+    def ids_for_fields(self, fields):
+        bits = self._field_bits(fields)
+        if not bits:
+            return np.zeros(0, dtype="int64")
+        return np.setdiff1d(np.flatnonzero(self.field_masks & bits), self.deleted)
+
+    def live_filter(self):
+        """Bitset of the items not deleted, None when nothing is, and how many there are."""
+        if self._live is None:
+            return None, len(self)
+        return self._live, len(self) - len(self.deleted)
+
+    def field_filter(self, fields):
+        """Bitset of the live items tagged with any of `fields`, and how many there are."""
+        bits = self._field_bits(fields)
+        if not bits:
+            return np.zeros((len(self) + 7) // 8, dtype="uint8"), 0
+        bitmap = self._bitmaps.get(int(bits))
+        if bitmap is None:
+            bitmap = np.packbits((self.field_masks & bits) != 0, bitorder="little")
+            self._bitmaps[int(bits)] = bitmap
+        if self._live is not None:
+            bitmap = bitmap & self._live
+        return bitmap, int(np.unpackbits(bitmap).sum())
+
+    def __getitem__(self, i):
+        return {
+            "text": self.text(i),
+            "fields": self.fields[i],
+            "source": self.sources[i],
+            "embedding": np.asarray(self.embeddings[i], dtype="float32"),
+        }
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
@@ -0,0 +1,180 @@
+import os
+import threading
+import numpy as np
+from dotenv import load_dotenv
+from agno.utils.log import log_debug, log_error
+from .chunking import chunk_text
+from .embedding_utils import get_embeddings_bulk
+from .engine import get_engine
+from .index_store import build_index, build_knowledge_indexes, extend_index, index_name, load_index, load_manifest, save_index
+from .knowledge_store import KnowledgeStore
+from .lexical_index import LEXICAL_DIR, LexicalIndex, build_lexical_index
+
+load_dotenv()
+
+# Retrain once appended plus deleted items exceed this share of the items the index was trained on
+INDEX_RETRAIN_RATIO = float(os.getenv("INDEX_RETRAIN_RATIO", 0.2))
+
+_UPDATE_LOCK = threading.Lock()
+_RETRAIN_THREAD = None
+
+def add_documents(documents, metric="cosine", retrain="auto", background=True):
+    """Chunk, embed and append documents, given as {"source", "text", "fields"} dicts.
+
+    The source path is the document's stable id. Searches keep being served from the
+    previous snapshot until the new one and its indexes are ready.
+    """
+    return _update(documents, [], metric, retrain, background)
+
+def delete_documents(sources, metric="cosine", retrain="auto", background=True):
+    """Delete the documents with the given source paths."""
+    return _update([], sources, metric, retrain, background)
+
+def replace_documents(documents, metric="cosine", retrain="auto", background=True):
+    """Replace documents by source path, unknown ones are added and unchanged ones skipped."""
+    return _update(documents, [d["source"] for d in documents], metric, retrain, background)
+
+def _chunk_documents(documents, first_doc_id):
+    texts, fields, sources, spans = [], [], [], []
+    for doc_id, document in enumerate(documents, first_doc_id):
+        text = document["text"]
+        for start, end in chunk_text(text):
+            texts.append(text[start:end])
+            fields.append(list(document["fields"]))
+            sources.append(document["source"])
+            spans.append((doc_id, start, end))
+    return texts, fields, sources, spans
+
+def _changed(knowledge, documents):
+    """Documents whose chunks differ from the stored ones, re-adding the rest would only churn the index."""
+    changed = []
+    for document in documents:
+        rows = knowledge.ids_for_sources([document["source"]])
+        chunks = [document["text"][start:end] for start, end in chunk_text(document["text"])]
+        if [knowledge.text(i) for i in rows] != chunks or any(
+            sorted(knowledge.fields[i]) != sorted(document["fields"]) for i in rows
+        ):
+            changed.append(document)
+    return changed
+
+def _migrate(engine, knowledge, metric):
+    """Write an in-memory snapshot (none yet, or the legacy knowledge.json) as the store at the engine's path."""
+    KnowledgeStore.write(
+        engine.path,
+        [knowledge.text(i) for i in range(len(knowledge))],
+        [knowledge.fields[i] for i in range(len(knowledge))],
+        [knowledge.sources[i] for i in range(len(knowledge))],
+        knowledge.embeddings,
+        spans=knowledge.spans,
+    )
+    migrated = KnowledgeStore.open(engine.path)
+    if len(migrated):
+        build_knowledge_indexes(migrated, metric)
+        build_lexical_index(migrated)
+    engine.set_snapshot(migrated)
+    log_debug(f"Knowledge store created at {engine.path} from {len(migrated)} in-memory items")
+    return migrated
+
+def _update(documents, delete_sources, metric, retrain, background):
+    engine = get_engine()
+    with _UPDATE_LOCK:
+        knowledge = engine.knowledge()
+        name = index_name("all", metric)
+
+        if delete_sources and documents:
+            documents = _changed(knowledge, documents)
+            delete_sources = [d["source"] for d in documents]
+        delete = knowledge.ids_for_sources(delete_sources)
+        texts, fields, sources, spans = _chunk_documents(documents, knowledge.next_document_id())
+        if not texts and not delete:
+            return knowledge
+        if knowledge.path is None:
+            # Item ids are kept, `delete` still applies to the written store
+            knowledge = _migrate(engine, knowledge, metric)
+
+        if not texts:
+            # Item ids and the fingerprint are unchanged, the indexes stay valid
+            updated = knowledge.delete(delete)
+            engine.set_snapshot(updated)
+        else:
+            embeddings = get_embeddings_bulk(texts)
+            manifest = load_manifest(knowledge, name)
+            # A private copy of the prebuilt index is extended in place, the served one keeps
+            # answering searches; without one, the served index is copied
+            index = load_index(knowledge, name, mmap=False)
+            copy = index is None
+            if index is None:
+                index = engine.index(knowledge, metric)
+
+            # Staged: the indexes are saved under the new fingerprint before meta.json commits it,
+            # a process reloading meanwhile finds them prebuilt instead of building its own
+            updated = knowledge.append(texts, fields, sources, embeddings, spans, delete=delete, commit=False)
+            if index is None:
+                index, params = build_index(updated.embeddings, metric)
+            else:
+                index = extend_index(index, embeddings, metric, copy=copy)
+                params = None
+                if manifest is not None and manifest.get("knowledge_fingerprint") == knowledge.fingerprint:
+                    params = manifest.get("index_params")
+                params = params or {"trained_on": len(knowledge)}
+            save_index(updated, name, index, metric, "all", params)
+
+            lexical = engine.lexical(knowledge).extend(updated)
+            lexical.save(os.path.join(updated.path, LEXICAL_DIR))
+
+            updated.commit()
+            engine.set_snapshot(updated, {metric: index}, lexical)
+
+        log_debug(f"Knowledge updated: {len(texts)} chunks added, {len(delete)} deleted")
+
+    if retrain is True or (retrain == "auto" and needs_retrain(updated, metric)):
+        retrain_indexes(metric=metric, background=background)
+    return updated
+
+def needs_retrain(knowledge, metric="cosine"):
+    """Whether enough was appended or deleted since training that the centroids have drifted."""
+    manifest = load_manifest(knowledge, index_name("all", metric)) or {}
+    trained_on = (manifest.get("index_params") or {}).get("trained_on", len(knowledge))
+    drift = len(knowledge) - trained_on + len(knowledge.deleted)
+    return drift > INDEX_RETRAIN_RATIO * max(trained_on, 1)
+
+def retrain_indexes(metric="cosine", background=True):
+    """Drop deleted items for good and rebuild the indexes, index type and centroids included.
+
+    In the background the current snapshot keeps serving until the rebuilt one is swapped in.
+    """
+    global _RETRAIN_THREAD
+    if not background:
+        return _retrain(metric)
+    if _RETRAIN_THREAD is not None and _RETRAIN_THREAD.is_alive():
+        return _RETRAIN_THREAD
+    _RETRAIN_THREAD = threading.Thread(target=_retrain, args=(metric,), name="knowledge-retrain", daemon=True)
+    _RETRAIN_THREAD.start()
+    return _RETRAIN_THREAD
+
+def _retrain(metric):
+    engine = get_engine()
+    try:
+        with _UPDATE_LOCK:
+            knowledge = engine.knowledge()
+            if len(knowledge) == 0:
+                return knowledge
+
+            # Train before rewriting the store, other processes reload it as soon as it changes
+            live = np.setdiff1d(np.arange(len(knowledge)), knowledge.deleted)
+            index, params = build_index(knowledge.embeddings[live], metric)
+
+            lexical = None
+            if len(knowledge.deleted):
+                knowledge = knowledge.compact(commit=False)
+                lexical = LexicalIndex.build(knowledge)
+                lexical.save(os.path.join(knowledge.path, LEXICAL_DIR))
+            save_index(knowledge, index_name("all", metric), index, metric, "all", params)
+            knowledge.commit()
+
+            engine.set_snapshot(knowledge, {metric: index}, lexical)
+            log_debug(f"Retrained {params['type']} index over {len(knowledge)} vectors")
+            return knowledge
+    except Exception as e:
+        log_error(f"Index retraining failed: {e}")
+        raise
@@ -0,0 +1,218 @@
+import os
+import re
+import json
+import unicodedata
+import numpy as np
+from agno.utils.log import log_debug, log_warning
+
+LEXICAL_DIR = "lexical"
+
+# Words, numbers and legal references such as 15/2020/NĐ-CP or 2.3
+_TOKEN = re.compile(r"\w+(?:[/\-.]\w+)*")
+# Bumped whenever tokenize() changes, indexes built with another version are rebuilt
+TOKENIZER_VERSION = 1
+
+def fold_diacritics(token: str) -> str:
+    """Strip Vietnamese tone and vowel marks: "nghị định" -> "nghi dinh"."""
+    decomposed = unicodedata.normalize("NFD", token.replace("đ", "d").replace("Đ", "D"))
+    return "".join(c for c in decomposed if unicodedata.category(c) != "Mn")
+
+def tokenize(text: str, bigrams=True):
+    """NFC-normalized lowercase syllables, each also indexed without diacritics.
+
+    Compound references are kept whole and split into their parts, and consecutive
+    syllables are paired so multi-syllable words such as "nghị định" can match as a unit.
+    Compounds and pairs are folded too, "nghi dinh" finds "nghị định" as a unit.
+    """
+    syllables = []
+    tokens = []
+    for match in _TOKEN.finditer(unicodedata.normalize("NFC", text).lower()):
+        token = match.group()
+        parts = re.split(r"[/\-.]", token)
+        if len(parts) > 1:
+            tokens.append(token)
+            folded = fold_diacritics(token)
+            if folded != token:
+                tokens.append(folded)
+        for part in parts:
+            folded = fold_diacritics(part)
+            syllables.append((part, folded))
+            tokens.append(part)
+            if folded != part:
+                tokens.append(folded)
+
+    if bigrams:
+        for (a, folded_a), (b, folded_b) in zip(syllables, syllables[1:]):
+            tokens.append(f"{a}_{b}")
+            if (folded_a, folded_b) != (a, b):
+                tokens.append(f"{folded_a}_{folded_b}")
+    return tokens
+
+class LexicalIndex:
+    """BM25 over a CSR inverted index: term -> (doc ids, term frequencies)."""
+
+    def __init__(
+        self, vocab, indptr, doc_ids, tfs, doc_lens, fingerprint=None, k1=1.2, b=0.75, tokenizer=TOKENIZER_VERSION
+    ):
+        self.vocab = vocab
+        self.indptr = indptr
+        self.doc_ids = doc_ids
+        self.tfs = tfs
+        self.doc_lens = doc_lens
+        self.fingerprint = fingerprint
+        self.tokenizer = tokenizer
+        self.k1 = k1
+        self.b = b
+        self.avgdl = float(doc_lens.mean()) if len(doc_lens) else 0.0
+        n = len(doc_lens)
+        df = np.diff(indptr)
+        self.idf = np.log(1 + (n - df + 0.5) / (df + 0.5)).astype("float32")
+
+    @staticmethod
+    def _postings(knowledge, start=0):
+        postings = {}
+        doc_lens = np.zeros(len(knowledge) - start, dtype="int32")
+        for i in range(start, len(knowledge)):
+            tokens = tokenize(knowledge.text(i))
+            doc_lens[i - start] = len(tokens)
+            counts = {}
+            for token in tokens:
+                counts[token] = counts.get(token, 0) + 1
+            for token, count in counts.items():
+                postings.setdefault(token, []).append((i, count))
+        return postings, doc_lens
+
+    @classmethod
+    def build(cls, knowledge):
+        postings, doc_lens = cls._postings(knowledge)
+
+        vocab = {}
+        indptr = np.zeros(len(postings) + 1, dtype="int64")
+        doc_ids = []
+        tfs = []
+        for term_id, (token, plist) in enumerate(postings.items()):
+            vocab[token] = term_id
+            indptr[term_id + 1] = indptr[term_id] + len(plist)
+            doc_ids.extend(d for d, _ in plist)
+            tfs.extend(c for _, c in plist)
+
+        return cls(
+            vocab, indptr,
+            np.array(doc_ids, dtype="int32"),
+            np.array(tfs, dtype="float32"),
+            doc_lens,
+            fingerprint=knowledge.fingerprint,
+        )
+
+    def extend(self, knowledge):
+        """A new index that also covers the items `knowledge` appended after the ones indexed here.
+
+        Only the new items are tokenized, the existing postings are merged in as they are.
+        """
+        start = len(self.doc_lens)
+        postings, doc_lens = self._postings(knowledge, start)
+
+        vocab = dict(self.vocab)
+        new_terms = []
+        new_docs = []
+        new_tfs = []
+        for token, plist in postings.items():
+            term_id = vocab.setdefault(token, len(vocab))
+            new_terms.extend([term_id] * len(plist))
+            new_docs.extend(d for d, _ in plist)
+            new_tfs.extend(c for _, c in plist)
+
+        terms = np.concatenate([
+            np.repeat(np.arange(len(self.vocab), dtype="int64"), np.diff(self.indptr)),
+            np.array(new_terms, dtype="int64"),
+        ])
+        # Stable, so each posting list keeps ascending doc ids
+        order = np.argsort(terms, kind="stable")
+        indptr = np.zeros(len(vocab) + 1, dtype="int64")
+        indptr[1:] = np.cumsum(np.bincount(terms, minlength=len(vocab)))
+
+        return LexicalIndex(
+            vocab, indptr,
+            np.concatenate([self.doc_ids, np.array(new_docs, dtype="int32")])[order],
+            np.concatenate([self.tfs, np.array(new_tfs, dtype="float32")])[order],
+            np.concatenate([self.doc_lens, doc_lens]),
+            fingerprint=knowledge.fingerprint,
+            k1=self.k1,
+            b=self.b,
+            tokenizer=self.tokenizer,
+        )
+
+    def save(self, path):
+        os.makedirs(path, exist_ok=True)
+        # Renamed into place, a live process may have the previous files mapped
+        for name in ["indptr", "doc_ids", "tfs", "doc_lens"]:
+            tmp = os.path.join(path, f".{name}.npy.tmp")
+            with open(tmp, "wb") as f:
+                np.save(f, getattr(self, name))
+            os.replace(tmp, os.path.join(path, f"{name}.npy"))
+        tmp = os.path.join(path, ".vocab.json.tmp")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(
+                {"fingerprint": self.fingerprint, "tokenizer": self.tokenizer, "vocab": self.vocab},
+                f, ensure_ascii=False,
+            )
+        os.replace(tmp, os.path.join(path, "vocab.json"))
+
+    @classmethod
+    def open(cls, path):
+        with open(os.path.join(path, "vocab.json"), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ["indptr", "doc_ids", "tfs", "doc_lens"]
+        }
+        return cls(meta["vocab"], fingerprint=meta["fingerprint"], tokenizer=meta.get("tokenizer"), **arrays)
+
+    def search(self, query: str, k=10, bitmap=None):
+        """Top `k` (doc id, score) pairs for `query`, restricted to the ids set in `bitmap` when given."""
+        n = len(self.doc_lens)
+        scores = np.zeros(n, dtype="float32")
+        norm = self.k1 * (1 - self.b + self.b * self.doc_lens / max(self.avgdl, 1e-6))
+
+        for token in set(tokenize(query)):
+            term_id = self.vocab.get(token)
+            if term_id is None:
+                continue
+            start, end = self.indptr[term_id], self.indptr[term_id + 1]
+            docs = self.doc_ids[start:end]
+            tf = self.tfs[start:end]
+            scores[docs] += self.idf[term_id] * tf * (self.k1 + 1) / (tf + norm[docs])
+
+        if bitmap is not None:
+            scores[~np.unpackbits(bitmap, bitorder="little")[:n].astype(bool)] = 0
+
+        candidates = np.flatnonzero(scores)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(i), float(scores[i])) for i in candidates]
+
+def load_lexical_index(knowledge):
+    """Prebuilt lexical index of the knowledge store, built in-process when missing or stale."""
+    if knowledge.path is not None and knowledge.fingerprint is not None:
+        path = os.path.join(knowledge.path, LEXICAL_DIR)
+        if os.path.exists(os.path.join(path, "vocab.json")):
+            index = LexicalIndex.open(path)
+            if index.fingerprint == knowledge.fingerprint and index.tokenizer == TOKENIZER_VERSION:
+                return index
+            log_warning("Prebuilt lexical index belongs to another knowledge snapshot or tokenizer, rebuilding")
+
+    index = LexicalIndex.build(knowledge)
+    log_debug(f"Built lexical index over {len(knowledge)} documents")
+    return index
+
+def build_lexical_index(knowledge):
+    LexicalIndex.build(knowledge).save(os.path.join(knowledge.path, LEXICAL_DIR))
+
+def reciprocal_rank_fusion(rankings, k=60):
+    """Fuse several ranked id lists, each id scores sum(1 / (k + rank))."""
+    scores = {}
+    for ranking in rankings:
+        for rank, item in enumerate(ranking):
+            scores[item] = scores.get(item, 0.0) + 1.0 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
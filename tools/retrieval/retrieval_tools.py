@@ -1,9 +1,32 @@
+import os
+import requests
+from dotenv import load_dotenv
+from requests.adapters import HTTPAdapter
 from textwrap import dedent
 from typing import Any, Dict, List, Optional, Literal
 
 from agno.tools import Toolkit
-from agno.utils.log import log_debug, log_error
+from agno.utils.log import log_debug, log_error, log_warning
 from .embedding_utils import *
+from .engine import get_engine
+from .lexical_index import reciprocal_rank_fusion
+from .context_packing import CONTEXT_RANK_WEIGHT, CONTEXT_TOKEN_BUDGET, pack_passages
+
+load_dotenv()
+# retrieval_api base url (e.g. http://localhost:2206), unset searches in this process
+RETRIEVAL_API_URL = os.getenv("RETRIEVAL_API_URL")
+RETRIEVAL_API_TIMEOUT = float(os.getenv("RETRIEVAL_API_TIMEOUT", 60))
+RETRIEVAL_API_POOL_SIZE = int(os.getenv("RETRIEVAL_API_POOL_SIZE", 32))
+
+# Keep-alive connections to the retrieval service, shared by every toolkit of the process
+_API_SESSION = requests.Session()
+_API_SESSION.mount("http://", HTTPAdapter(pool_maxsize=RETRIEVAL_API_POOL_SIZE))
+_API_SESSION.mount("https://", HTTPAdapter(pool_maxsize=RETRIEVAL_API_POOL_SIZE))
+
+Field = Literal[
+    "circular", "constitution", "culture", "decree",
+    "geography", "history", "law", "philosophy", "regulation",
+    "others"]
 
 class RetrievalTools(Toolkit):
     def __init__(
@@ -12,55 +35,205 @@ class RetrievalTools(Toolkit):
         enable_filter=True,
         distance_metric="cosine",
         k=10,
+        preload=True,
+        pack=True,
+        token_budget=CONTEXT_TOKEN_BUDGET,
+        engine=None,
+        api_url=RETRIEVAL_API_URL,
         **kwargs,
     ):
         self.enable_hybrid = enable_hybrid
         self.enable_filter = enable_filter
         self.distance_metric = distance_metric
         self.k = k
+        # Return numbered, deduplicated and trimmed snippets instead of raw passages
+        self.pack = pack
+        self.token_budget = token_budget
+        # With a retrieval service the store and indexes live there, nothing is loaded here
+        self.api_url = api_url
+        # Shared by every toolkit of the process, tool calls may run in parallel threads
+        self.engine = engine or get_engine()
+
+        if preload and not api_url:
+            self.engine.preload(metric=distance_metric, lexical=enable_hybrid)
 
         super().__init__(
             name="retrieval_tools",
-            tools=[self.retrieval],
+            tools=[self.retrieval, self.retrieval_batch],
             **kwargs,
         )
 
-    def retrieval(self, query: str, fields: List[Literal[
-        "circular", "constitution", "culture", "decree", 
-        "geography" "history", "law", "philosophy", "regulation", 
-        "others"]]):
+    def _remote(self, path, payload):
+        res = _API_SESSION.post(
+            f"{self.api_url}{path}",
+            json={
+                **payload,
+                "k": self.k,
+                "enable_hybrid": self.enable_hybrid,
+                "enable_filter": self.enable_filter,
+                "distance_metric": self.distance_metric,
+                "pack": self.pack,
+                "token_budget": self.token_budget,
+            },
+            timeout=RETRIEVAL_API_TIMEOUT,
+        )
+        res.raise_for_status()
+        return res.json()["results"]
+
+    def _field_filter(self, knowledge, fields):
+        if self.enable_filter and fields:
+            return knowledge.field_filter(fields)
+        return knowledge.live_filter()
+
+    def _fuse(self, knowledge, query, vector_ids, bitmap):
+        """Reciprocal-rank fusion of vector hits with BM25 hits, vector hits only without hybrid."""
+        if not self.enable_hybrid:
+            return vector_ids
+        lexical_ids = [i for i, _ in self.engine.lexical(knowledge).search(query, k=self.k, bitmap=bitmap)]
+        return reciprocal_rank_fusion([vector_ids, lexical_ids])[:self.k]
+
+    def _passages(self, knowledge, ids, context=0):
+        """(id, text) of the hits, each widened by `context` neighbouring chunks of its document when asked."""
+        if context <= 0:
+            return [(i, knowledge.text(i)) for i in ids]
+
+        passages = []
+        covered = set()
+        for i in ids:
+            if i in covered:
+                continue
+            text, chunk_ids = knowledge.context(i, window=context)
+            covered.update(chunk_ids)
+            passages.append((i, text))
+        return passages
+
+    def _texts(self, knowledge, query, query_emb, ids, context=0, token_budget=None):
+        passages = self._passages(knowledge, ids, context)
+        if not self.pack:
+            return [text for _, text in passages]
+        return pack_passages(
+            query, passages, knowledge,
+            query_emb=query_emb,
+            token_budget=token_budget or self.token_budget,
+            # Fused ranks include BM25 hits the cosine would push down
+            rank_weight=CONTEXT_RANK_WEIGHT if self.enable_hybrid else 0.0,
+        )
+
+    def retrieval(self, query: str, fields: List[Field], context: int = 0):
         try:
             log_debug(f"Retrieval for {query}")
 
-            knowledge = load_knowledge()
+            if self.api_url:
+                return self._remote("/retrieve", {"query": query, "fields": fields, "context": context})
 
-            if self.enable_filter and fields:
-                field_key = "_".join(sorted(fields))
-                data = [
-                    x for x in knowledge
-                    if any(d in fields for d in x["fields"])
-                ]
-            else:
-                field_key = "all"
-                data = knowledge
+            knowledge = self.engine.knowledge()
 
-            query_emb = get_embedding(query)
+            bitmap, n_selected = self._field_filter(knowledge, fields)
+            if n_selected == 0:
+                return []
 
-            # TODO hybrid
-            if self.enable_hybrid:
-                pass
+            try:
+                query_emb = get_embedding(query)
+            except requests.RequestException as e:
+                if not self.enable_hybrid:
+                    raise
+                log_warning(f"Embedding failed, falling back to lexical search: {e}")
+                query_emb = []
+
+            vector_ids = []
+            if len(query_emb) > 0:
+                result = self.engine.vector_search(
+                    knowledge,
+                    [query_emb],
+                    k=self.k,
+                    metric=self.distance_metric,
+                    bitmap=bitmap,
+                    n_selected=n_selected
+                )[0]
+                vector_ids = [r['item'] for r in result]
+            elif not self.enable_hybrid:
+                return []
+
+            ids = self._fuse(knowledge, query, vector_ids, bitmap)
+            return self._texts(knowledge, query, query_emb, ids, context)
+
+        except Exception as e:
+            log_error(f"Retrieval error: {e}")
+            return f"Lỗi retrieval: {e}"
+
+    def retrieval_batch(self, queries: List[str], fields: List[Field], context: int = 0):
+        """Retrieve for several queries at once, results are grouped per query.
 
-            index = get_ivf_index(field_key, data, metric=self.distance_metric)
+        A passage matching several queries is only returned under the query it matches best.
+        """
+        try:
+            log_debug(f"Batch retrieval for {queries}")
+
+            if self.api_url:
+                return self._remote("/retrieve/batch", {"queries": queries, "fields": fields, "context": context})
 
-            result = vector_search(
-                index=index,
-                data=data,
-                query_emb=query_emb,
-                k=self.k,
-                metric=self.distance_metric
-            )
+            knowledge = self.engine.knowledge()
 
-            return [r['item']['text'] for r in result]
+            bitmap, n_selected = self._field_filter(knowledge, fields)
+            if n_selected == 0 or not queries:
+                return [{"query": q, "results": []} for q in queries]
+
+            try:
+                query_embs = get_embeddings(queries)
+            except (requests.RequestException, EmbeddingError) as e:
+                if not self.enable_hybrid:
+                    raise
+                log_warning(f"Embedding failed, falling back to lexical search: {e}")
+                query_embs = []
+            embedded = len(query_embs) == len(queries) and all(len(e) > 0 for e in query_embs)
+            if not embedded and not self.enable_hybrid:
+                raise EmbeddingError("Embedding request for the queries failed")
+
+            results = [[] for _ in queries]
+            if embedded:
+                results = self.engine.vector_search(
+                    knowledge,
+                    query_embs,
+                    k=self.k,
+                    metric=self.distance_metric,
+                    bitmap=bitmap,
+                    n_selected=n_selected
+                )
+
+            if self.enable_hybrid:
+                # Fused rank stands in for the score when deduplicating across queries
+                results = [
+                    [{"item": i, "score": -rank} for rank, i in enumerate(
+                        self._fuse(knowledge, query, [r["item"] for r in row], bitmap)
+                    )]
+                    for query, row in zip(queries, results)
+                ]
+
+            # Keep each passage under the query with the best score
+            higher_is_better = self.enable_hybrid or self.distance_metric == "cosine"
+            best = {}
+            for qi, row in enumerate(results):
+                for r in row:
+                    seen = best.get(r["item"])
+                    if seen is None or (r["score"] > seen[1] if higher_is_better else r["score"] < seen[1]):
+                        best[r["item"]] = (qi, r["score"])
+
+            # The budget covers the whole call, split evenly between the queries
+            token_budget = max(self.token_budget // len(queries), 1)
+            return [
+                {
+                    "query": query,
+                    "results": self._texts(
+                        knowledge,
+                        query,
+                        query_embs[qi] if embedded else None,
+                        [r["item"] for r in row if best[r["item"]][0] == qi],
+                        context,
+                        token_budget,
+                    )
+                }
+                for qi, (query, row) in enumerate(zip(queries, results))
+            ]
 
         except Exception as e:
             log_error(f"Retrieval error: {e}")
@@ -73,12 +246,14 @@ class RetrievalTools(Toolkit):
     DEFAULT_INSTRUCTIONS = dedent(
         """\
         Bạn có quyền sử dụng công cụ `retrieval` để tìm kiếm thông tin. 
-        Cách dùng: `retrieval` để tìm thông tin dựa trên nội dung cần truy vấn `query` và các lĩnh vực `fields` liên quan đến nội dung truy vấn."""
+        Cách dùng: `retrieval` để tìm thông tin dựa trên nội dung cần truy vấn `query` và các lĩnh vực `fields` liên quan đến nội dung truy vấn.
+        Mỗi kết quả là một đoạn trích được đánh số kèm nguồn (`[1] (nguồn: ... | id: ...)`), chỉ giữ các câu liên quan nhất đến truy vấn; đặt `context` = 1 hoặc 2 để lấy thêm các đoạn liền kề trong cùng văn bản khi cần ngữ cảnh rộng hơn.
+        Khi cần tra cứu nhiều nội dung cùng lúc, dùng `retrieval_batch` với danh sách truy vấn `queries` thay vì gọi `retrieval` nhiều lần."""
     )
 
     FEW_SHOT_EXAMPLES = dedent(
         """
-        Dưới đây là các ví dụ minh họa cách sử dụng công cụ `retrieval`.
+        Dưới đây là các ví dụ minh họa cách sử dụng công cụ `retrieval` và `retrieval_batch`.
 
         ### Ví dụ
 
@@ -105,26 +280,16 @@ class RetrievalTools(Toolkit):
         *Quy trình nội bộ của Agent:*
 
         ```tool_call
-        retrieval(
-          query="Các cải cách kinh tế - chính trị cốt lõi của chính sách Đổi Mới năm 1986",
+        retrieval_batch(
+          queries=[
+            "Các cải cách kinh tế - chính trị cốt lõi của chính sách Đổi Mới năm 1986",
+            "Tốc độ tăng trưởng GDP Việt Nam trong thập niên 1990",
+            "Quá trình chuyển đổi kinh tế và tốc độ tăng trưởng GDP của Việt Nam so với các nước Đông Âu"
+          ],
           fields=["history", "politics", "economy"]
         )
         ```
 
-        ```tool_call
-        retrieval(
-          query="Tốc độ tăng trưởng GDP Việt Nam trong thập niên 1990",
-          fields=["economy"]
-        )
-        ```
-
-        ```tool_call
-        retrieval(
-          query="Quá trình chuyển đổi kinh tế và tốc độ tăng trưởng GDP của Việt Nam so với các nước Đông Âu",
-          fields=["history", "economy"]
-        )
-        ```
-
         *Câu trả lời cuối cùng của Agent cho người dùng:*
         Đổi Mới 1986 mở cửa kinh tế, cho phép tư nhân, tự do hóa thương mại và cải cách quản lý, giúp Việt Nam thoát khủng hoảng và tăng trưởng GDP ổn định 7–9% trong thập niên 1990.
         Trong khi đó, nhiều nước Đông Âu áp dụng “liệu pháp sốc”, dẫn đến suy giảm kinh tế mạnh đầu giai đoạn chuyển đổi."""